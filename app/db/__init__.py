@@ -23,14 +23,14 @@ def get_db():  # Dependency
         yield db
 
 
-from .crud import (create_admin, create_notification_reminder,  # noqa
-                   create_user, delete_notification_reminder, get_admin,
+from .crud import (count_users, create_admin, create_notification_reminder,  # noqa
+                   create_user, decode_users_cursor, delete_notification_reminder, encode_users_cursor, get_admin,
                    get_admins, get_jwt_secret_key, get_notification_reminder,
                    get_or_create_inbound, get_system_usage,
-                   get_tls_certificate, get_user, get_user_by_id, get_users,
-                   get_users_count, remove_admin, remove_user, revoke_user_sub,
+                   get_tls_certificate, get_user, get_user_by_id, get_user_for_subscription, get_users,
+                   get_users_count, get_users_expiring_between, get_users_to_review, remove_admin, remove_user, revoke_user_sub,
                    set_owner, update_admin, update_user, update_user_status, reset_user_by_next,
-                   update_user_sub, start_user_expire, get_admin_by_id,
+                   update_user_sub, update_users_sub, start_user_expire, get_admin_by_id,
                    get_admin_by_telegram_id)
 
 from .models import JWT, System, User  # noqa
@@ -39,14 +39,21 @@ __all__ = [
     "get_or_create_inbound",
     "get_user",
     "get_user_by_id",
+    "get_user_for_subscription",
     "get_users",
     "get_users_count",
+    "count_users",
+    "encode_users_cursor",
+    "decode_users_cursor",
+    "get_users_to_review",
+    "get_users_expiring_between",
     "create_user",
     "remove_user",
     "update_user",
     "update_user_status",
     "start_user_expire",
     "update_user_sub",
+    "update_users_sub",
     "reset_user_by_next",
     "revoke_user_sub",
     "set_owner",
@@ -2,12 +2,18 @@
 Functions for managing proxy hosts, users, user templates, nodes, and administrative tasks.
 """
 
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from sqlalchemy import and_, delete, func, or_
-from sqlalchemy.orm import Query, Session, joinedload
+from sqlalchemy import DateTime, and_, bindparam, case, delete, exists, false, func, insert, or_, update
+from sqlalchemy.orm import Query, Session, joinedload, selectinload
+from sqlalchemy.sql import operators
 from sqlalchemy.sql.functions import coalesce
 
 from app.db.models import (
@@ -19,6 +25,8 @@ from app.db.models import (
     Node,
     NodeUsage,
     NodeUserUsage,
+    NodeUserUsageDaily,
+    NodeUserUsageMonthly,
     NotificationReminder,
     Proxy,
     ProxyHost,
@@ -29,8 +37,9 @@ from app.db.models import (
     UserTemplate,
     UserUsageResetLogs,
 )
+from app.db.search import users_search
 from app.models.admin import AdminCreate, AdminModify, AdminPartialModify
-from app.models.node import NodeCreate, NodeModify, NodeStatus, NodeUsageResponse
+from app.models.node import NodeCreate, NodeModify, NodeStatus, NodeUsageResponse, UsageGranularity
 from app.models.proxy import ProxyHost as ProxyHostModify
 from app.models.user import (
     ReminderType,
@@ -43,7 +52,13 @@ from app.models.user import (
 )
 from app.models.user_template import UserTemplateCreate, UserTemplateModify
 from app.utils.helpers import calculate_expiration_days, calculate_usage_percent
-from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, USERS_AUTODELETE_DAYS
+from app.utils.usage import user_admins, user_usages_write_lock
+from config import (
+    NOTIFY_DAYS_LEFT,
+    NOTIFY_REACHED_USAGE_PERCENT,
+    USERS_AUTODELETE_DAYS,
+    USERS_COUNT_CACHE_TTL,
+)
 
 
 def add_default_host(db: Session, inbound: ProxyInbound):
@@ -193,6 +208,21 @@ def get_user(db: Session, username: str) -> Optional[User]:
     return get_user_queryset(db).filter(User.username == username).first()
 
 
+def get_user_for_subscription(db: Session, username: str) -> Optional[User]:
+    """
+    Retrieves a user by username without joining its relations, which are
+    loaded only if they're accessed.
+
+    Args:
+        db (Session): Database session.
+        username (str): The username of the user.
+
+    Returns:
+        Optional[User]: The user object if found, else None.
+    """
+    return db.query(User).filter(User.username == username).first()
+
+
 def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
     """
     Retrieves a user by user ID.
@@ -221,6 +251,174 @@ UsersSortingOptions = Enum('UsersSortingOptions', {
 })
 
 
+def encode_users_cursor(user: User,
+                        sort: Optional[List[UsersSortingOptions]] = None,
+                        backward: bool = False) -> str:
+    """
+    Creates an opaque cursor pointing at a user, to get the users after (or before) it.
+
+    Args:
+        user (User): The last (or first, if backward) user of a page.
+        sort (Optional[List[UsersSortingOptions]]): Sorting options the page was retrieved with.
+        backward (bool): Whether the cursor is for the users before the given user.
+
+    Returns:
+        str: The cursor.
+    """
+    sort = sort or []
+    payload = {
+        "sort": [opt.name for opt in sort],
+        "values": [getattr(user, opt.name.lstrip("-")) for opt in sort],
+        "id": user.id,
+        "backward": backward,
+    }
+    data = json.dumps(payload, default=lambda v: v.isoformat(), separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_users_cursor(cursor: str,
+                        sort: Optional[List[UsersSortingOptions]] = None) -> Tuple[list, int, bool]:
+    """
+    Decodes a cursor created by encode_users_cursor.
+
+    Args:
+        cursor (str): The cursor.
+        sort (Optional[List[UsersSortingOptions]]): Sorting options of the requested page.
+
+    Returns:
+        Tuple[list, int, bool]: Values of the sort keys, ID of the user and whether the cursor is backward.
+
+    Raises:
+        ValueError: If the cursor is invalid or was created with other sorting options.
+    """
+    sort = sort or []
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        names, values, user_id, backward = payload["sort"], payload["values"], payload["id"], payload["backward"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+
+    if names != [opt.name for opt in sort] or len(values) != len(sort) or not isinstance(user_id, int):
+        raise ValueError("Cursor doesn't match the sorting options")
+
+    for i, opt in enumerate(sort):
+        column = getattr(User, opt.name.lstrip("-"))
+        if values[i] is not None and isinstance(column.type, DateTime):
+            values[i] = datetime.fromisoformat(values[i])
+
+    return values, user_id, bool(backward)
+
+
+def _users_keyset_filter(db: Session, sort: List[UsersSortingOptions], values: list, user_id: int, backward: bool):
+    """Returns the clause of the users that come after (or before) the cursor in the order of the sort keys and ID."""
+    # NULLs are ordered as the largest values on PostgreSQL and as the smallest ones on SQLite and MySQL
+    nulls_largest = db.bind.dialect.name == "postgresql"
+
+    keys = [(getattr(User, opt.name.lstrip("-")), opt.name.startswith("-") != backward, value)
+            for opt, value in zip(sort, values)]
+    keys.append((User.id, backward, user_id))
+
+    def equal(column, value):
+        return column.is_(None) if value is None else column == value
+
+    def after(column, descending, value):
+        if descending == nulls_largest:  # NULLs come first
+            return column.isnot(None) if value is None else (column < value if descending else column > value)
+        # NULLs come last
+        if value is None:
+            return false()
+        return or_(column < value if descending else column > value, column.is_(None))
+
+    return or_(*(
+        and_(*(equal(column, value) for column, _, value in keys[:i]), after(*keys[i]))
+        for i in range(len(keys))
+    ))
+
+
+def _filter_users(db: Session,
+                  query: Query,
+                  usernames: Optional[List[str]] = None,
+                  search: Optional[str] = None,
+                  status: Optional[Union[UserStatus, list]] = None,
+                  admin: Optional[Admin] = None,
+                  admins: Optional[List[str]] = None,
+                  reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None) -> Tuple[Query, bool]:
+    """
+    Applies the filters of get_users to a query of users, and returns it along with whether
+    the search narrowed the users down to a few that were found in the search index.
+    """
+    narrowed = False
+    if search:
+        clause, narrowed = users_search.clause(db, search)
+        query = query.filter(clause)
+
+    if usernames:
+        query = query.filter(User.username.in_(usernames))
+
+    if status:
+        if isinstance(status, list):
+            query = query.filter(User.status.in_(status))
+        else:
+            query = query.filter(User.status == status)
+
+    if reset_strategy:
+        if isinstance(reset_strategy, list):
+            query = query.filter(User.data_limit_reset_strategy.in_(reset_strategy))
+        else:
+            query = query.filter(User.data_limit_reset_strategy == reset_strategy)
+
+    if admin:
+        query = query.filter(User.admin == admin)
+
+    if admins:
+        query = query.filter(User.admin.has(Admin.username.in_(admins)))
+
+    return query, narrowed
+
+
+# filters of get_users -> (time, count), to answer approximate counts, in the order they were counted
+_users_counts: "OrderedDict[tuple, Tuple[float, int]]" = OrderedDict()
+_users_counts_lock = threading.Lock()
+# searches as you type count many filters once, the oldest counts are forgotten beyond this many
+USERS_COUNTS_MAX_SIZE = 1000
+
+
+def count_users(db: Session, approximate: bool = False, **filters) -> int:
+    """
+    Counts the users matching the filters of get_users, on the users table alone.
+
+    Args:
+        db (Session): Database session.
+        approximate (bool): Whether a count made in the last USERS_COUNT_CACHE_TTL seconds can be returned.
+        **filters: Filters of get_users (usernames, search, status, admin, admins, reset_strategy).
+
+    Returns:
+        int: Number of users.
+    """
+    key = tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else (value.id if isinstance(value, Admin) else value))
+        for name, value in filters.items() if value
+    ))
+    now = time.monotonic()
+
+    if approximate:
+        cached = _users_counts.get(key)
+        if cached and now - cached[0] < USERS_COUNT_CACHE_TTL:
+            return cached[1]
+
+    query, _ = _filter_users(db, db.query(func.count(User.id)), **filters)
+    count = query.scalar()
+
+    with _users_counts_lock:
+        _users_counts[key] = (now, count)
+        _users_counts.move_to_end(key)
+        while _users_counts and (len(_users_counts) > USERS_COUNTS_MAX_SIZE
+                                 or now - next(iter(_users_counts.values()))[0] >= USERS_COUNT_CACHE_TTL):
+            _users_counts.popitem(last=False)
+
+    return count
+
+
 def get_users(db: Session,
               offset: Optional[int] = None,
               limit: Optional[int] = None,
@@ -231,7 +429,10 @@ def get_users(db: Session,
               admin: Optional[Admin] = None,
               admins: Optional[List[str]] = None,
               reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None,
-              return_with_count: bool = False) -> Union[List[User], Tuple[List[User], int]]:
+              return_with_count: bool = False,
+              with_relations: bool = False,
+              cursor: Optional[str] = None,
+              approximate_count: bool = False) -> Union[List[User], Tuple[List[User], int]]:
     """
     Retrieves users based on various filters and options.
 
@@ -247,93 +448,336 @@ def get_users(db: Session,
         admins (Optional[List[str]]): List of admin usernames to filter users by.
         reset_strategy (Optional[Union[UserDataLimitResetStrategy, list]]): Data limit reset strategy to filter by.
         return_with_count (bool): Whether to return the total count of users.
+        with_relations (bool): Whether to load the proxies and usage logs of the users along with them,
+            instead of lazily per user.
+        cursor (Optional[str]): Cursor from encode_users_cursor, to retrieve the users after (or before) it
+            instead of skipping them with an offset.
+        approximate_count (bool): Whether the total count can be a cached one, see count_users.
 
     Returns:
         Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count.
+
+    Raises:
+        ValueError: If the cursor is invalid.
     """
-    query = get_user_queryset(db)
+    sort = sort or []
+    filters = dict(usernames=usernames, search=search, status=status,
+                   admin=admin, admins=admins, reset_strategy=reset_strategy)
+    query, narrowed = _filter_users(db, get_user_queryset(db), **filters)
 
-    if search:
-        query = query.filter(or_(User.username.ilike(f"%{search}%"), User.note.ilike(f"%{search}%")))
+    backward = False
+    if cursor:
+        values, user_id, backward = decode_users_cursor(cursor, sort)
+        query = query.filter(_users_keyset_filter(db, sort, values, user_id, backward))
 
-    if usernames:
-        query = query.filter(User.username.in_(usernames))
+    # the ID breaks the ties of the sort keys, so the order is stable for cursors and offsets
+    order = [opt.value for opt in sort] + [User.id.asc()]
+    if backward:
+        order = [clause.element.asc() if clause.modifier is operators.desc_op else clause.element.desc()
+                 for clause in order]
+    if narrowed:
+        order = users_search.order(db, order)
+    query = query.order_by(*order)
 
-    if status:
-        if isinstance(status, list):
-            query = query.filter(User.status.in_(status))
-        else:
-            query = query.filter(User.status == status)
+    if offset:
+        query = query.offset(offset)
+    if limit:
+        query = query.limit(limit)
 
-    if reset_strategy:
-        if isinstance(reset_strategy, list):
-            query = query.filter(User.data_limit_reset_strategy.in_(reset_strategy))
-        else:
-            query = query.filter(User.data_limit_reset_strategy == reset_strategy)
+    if with_relations:
+        query = query.options(
+            selectinload(User.proxies).selectinload(Proxy.excluded_inbounds),
+            selectinload(User.usage_logs),
+        )
 
-    if admin:
-        query = query.filter(User.admin == admin)
-
-    if admins:
-        query = query.filter(User.admin.has(Admin.username.in_(admins)))
+    users = query.all()
+    if backward:
+        users.reverse()
 
     if return_with_count:
-        count = query.count()
+        return users, count_users(db, approximate=approximate_count, **filters)
 
-    if sort:
-        query = query.order_by(*(opt.value for opt in sort))
+    return users
 
-    if offset:
-        query = query.offset(offset)
-    if limit:
-        query = query.limit(limit)
 
-    if return_with_count:
-        return query.all(), count
+def get_users_to_review(db: Session,
+                        status: UserStatus,
+                        user_ids: Optional[Iterable[int]] = None,
+                        expire_before: Optional[int] = None,
+                        on_hold_timeout_before: Optional[datetime] = None) -> List[User]:
+    """
+    Retrieves users of a status whose limits need to be checked.
 
-    return query.all()
+    Args:
+        db (Session): Database session.
+        status (UserStatus): Status of the users.
+        user_ids (Optional[Iterable[int]]): IDs of the users to check, None means all users with the status.
+        expire_before (Optional[int]): Also includes users whose expire timestamp is at or before this one.
+        on_hold_timeout_before (Optional[datetime]): Also includes users whose on hold timeout is at or before this.
+
+    Returns:
+        List[User]: List of users to check.
+    """
+    query = get_user_queryset(db).filter(User.status == status)
+    if user_ids is None:
+        return query.all()
+
+    conditions = []
+    if expire_before is not None:
+        conditions.append(and_(User.expire.isnot(None), User.expire <= expire_before))
+    if on_hold_timeout_before is not None:
+        conditions.append(and_(User.on_hold_timeout.isnot(None), User.on_hold_timeout <= on_hold_timeout_before))
 
+    users = {}
+    if conditions:
+        users.update((user.id, user) for user in query.filter(or_(*conditions)))
 
-def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -> List[UserUsageResponse]:
+    user_ids = sorted(set(user_ids) - set(users))
+    for i in range(0, len(user_ids), 1000):
+        users.update((user.id, user) for user in query.filter(User.id.in_(user_ids[i:i + 1000])))
+
+    return list(users.values())
+
+
+def get_users_expiring_between(db: Session, status: UserStatus, start: int, end: int) -> List[User]:
     """
-    Retrieves user usages within a specified date range.
+    Retrieves users of a status whose expire timestamp is after start and at or before end.
 
     Args:
         db (Session): Database session.
-        dbuser (User): The user object.
-        start (datetime): Start date for usage retrieval.
-        end (datetime): End date for usage retrieval.
+        status (UserStatus): Status of the users.
+        start (int): Start timestamp (exclusive).
+        end (int): End timestamp (inclusive).
 
     Returns:
-        List[UserUsageResponse]: List of user usage responses.
+        List[User]: List of users expiring in the range.
     """
+    return get_user_queryset(db).filter(User.status == status, User.expire > start, User.expire <= end).all()
 
-    usages = {0: UserUsageResponse(  # Main Core
-        node_id=None,
-        node_name="Master",
-        used_traffic=0
-    )}
 
-    for node in db.query(Node).all():
-        usages[node.id] = UserUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
-            used_traffic=0
-        )
+# start of the period a usage is in, the format is the same for SQLite's strftime and MySQL's DATE_FORMAT
+USAGE_PERIOD_FORMATS = {
+    UsageGranularity.hour: "%Y-%m-%d %H:00:00",
+    UsageGranularity.day: "%Y-%m-%d 00:00:00",
+    UsageGranularity.month: "%Y-%m-01 00:00:00",
+}
+
+
+def _usage_period(db: Session, column, granularity: UsageGranularity):
+    """Returns the SQL expression of the start of the period a usage record is in."""
+    dialect = db.bind.dialect.name
+    if dialect == "postgresql":
+        return func.date_trunc(granularity.value, column)
+    if dialect == "mysql":
+        return func.date_format(column, USAGE_PERIOD_FORMATS[granularity])
+    return func.strftime(USAGE_PERIOD_FORMATS[granularity], column)
+
+
+def _usage_nodes(db: Session) -> Dict[int, str]:
+    """Returns the names of the cores usages are recorded for, by node ID (0 is the main core)."""
+    return {0: "Master", **dict(db.query(Node.id, Node.name).order_by(Node.id).all())}
+
+
+def _sum_usages(db: Session,
+                query: Query,
+                created_at,
+                node_id,
+                granularity: Optional[UsageGranularity] = None) -> List[tuple]:
+    """
+    Groups the usages of a query (of the sums to return) by node and by period, in the database.
+
+    Args:
+        db (Session): Database session.
+        query (Query): Query of the sums of the usage columns, with the filters of the records to sum.
+        created_at: Time column of the usage records.
+        node_id: Node ID column of the usage records.
+        granularity (Optional[UsageGranularity]): Length of the periods, None to sum the whole range.
+
+    Returns:
+        List[tuple]: Node ID (0 is the main core), start of the period (None without granularity)
+            and the sums, ordered by period.
+    """
+    keys = [coalesce(node_id, 0)]
+    if granularity:
+        keys.append(_usage_period(db, created_at, granularity))
+
+    rows = []
+    for row in query.add_columns(*keys).group_by(*keys):
+        sums = list(row)
+        period_start = sums.pop() if granularity else None
+        if isinstance(period_start, str):
+            period_start = datetime.strptime(period_start, "%Y-%m-%d %H:%M:%S")
+        node = sums.pop()
+        rows.append((node, period_start, *(int(v or 0) for v in sums)))
 
-    cond = and_(NodeUserUsage.user_id == dbuser.id,
-                NodeUserUsage.created_at >= start,
-                NodeUserUsage.created_at <= end)
+    if granularity:
+        rows.sort(key=lambda row: (row[1], row[0]))
+    return rows
 
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
 
+# tiers of the users' usages, the hourly records are rolled up into daily ones after
+# USAGES_HOURLY_RETENTION_DAYS and those into monthly ones after USAGES_DAILY_RETENTION_DAYS
+USER_USAGE_TIERS = {
+    UsageGranularity.hour: NodeUserUsage,
+    UsageGranularity.day: NodeUserUsageDaily,
+    UsageGranularity.month: NodeUserUsageMonthly,
+}
+
+
+def _sum_user_usages(db: Session,
+                     start: datetime,
+                     end: datetime,
+                     granularity: Optional[UsageGranularity],
+                     filter_tier: Callable[[Query, type], Query]) -> List[tuple]:
+    """
+    Sums the users' usages of every tier, like ``_sum_usages``.
+
+    Rolled up records are counted whole when their period starts in the range,
+    and are grouped by the start of their own period when it's longer than ``granularity``.
+
+    Args:
+        db (Session): Database session.
+        start (datetime): Start date of the usages.
+        end (datetime): End date of the usages.
+        granularity (Optional[UsageGranularity]): Length of the periods, None to sum the whole range.
+        filter_tier (Callable[[Query, type], Query]): Adds the filters of the records to sum
+            to the query of a tier, given the model of the tier.
+
+    Returns:
+        List[tuple]: Node ID (0 is the main core), start of the period (None without granularity)
+            and the used traffic, ordered by period.
+    """
+    sums = {}
+    for model in USER_USAGE_TIERS.values():
+        query = db.query(func.sum(model.used_traffic)).filter(model.created_at >= start, model.created_at <= end)
+        query = filter_tier(query, model)
+        for node, period_start, used_traffic in _sum_usages(db, query, model.created_at, model.node_id, granularity):
+            sums[node, period_start] = sums.get((node, period_start), 0) + used_traffic
+
+    rows = [(node, period_start, used_traffic) for (node, period_start), used_traffic in sums.items()]
+    if granularity:
+        rows.sort(key=lambda row: (row[1], row[0]))
+    return rows
+
+
+def _usage_period_start(moment: datetime, granularity: UsageGranularity) -> datetime:
+    if granularity == UsageGranularity.month:
+        return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if granularity == UsageGranularity.day:
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _usage_period_end(period_start: datetime, granularity: UsageGranularity) -> datetime:
+    if granularity == UsageGranularity.month:
+        return (period_start + timedelta(days=32)).replace(day=1)
+    if granularity == UsageGranularity.day:
+        return period_start + timedelta(days=1)
+    return period_start + timedelta(hours=1)
+
+
+def rollup_user_usages(db: Session, granularity: UsageGranularity, before: datetime) -> int:
+    """
+    Compacts the users' usages of the finer tier into records of ``granularity`` (day or month),
+    for the periods which end before ``before``. Each period is compacted in its own transaction,
+    while no users' usages are being flushed.
+
+    Args:
+        db (Session): Database session.
+        granularity (UsageGranularity): Tier the usages are rolled up into.
+        before (datetime): The usages recorded before the period this is in are compacted.
+
+    Returns:
+        int: Number of compacted records.
+    """
+    tiers = list(USER_USAGE_TIERS)
+    source = USER_USAGE_TIERS[tiers[tiers.index(granularity) - 1]]
+    target = USER_USAGE_TIERS[granularity].__table__
+    before = _usage_period_start(before, granularity)
+
+    compacted = 0
+    while True:
+        oldest = db.query(func.min(source.created_at)).filter(source.created_at < before).scalar()
+        if oldest is None:
+            return compacted
+
+        period_start = _usage_period_start(oldest, granularity)
+        period = and_(source.created_at >= period_start,
+                      source.created_at < _usage_period_end(period_start, granularity))
+
+        # a flush adding to the period's records in between would have its usages deleted
+        with user_usages_write_lock:
+            sums = {}
+            for user_id, node_id, used_traffic, count in db.query(
+                    source.user_id, source.node_id, func.sum(source.used_traffic), func.count()
+            ).filter(period).group_by(source.user_id, source.node_id):
+                sums[user_id, node_id] = int(used_traffic or 0)
+                compacted += count
+
+            # the period is rolled up once, unless records were added to it afterwards
+            existings = {(user_id, node_id): id for id, user_id, node_id in db.execute(
+                target.select().with_only_columns(target.c.id, target.c.user_id, target.c.node_id)
+                .where(target.c.created_at == period_start)
+            )}
+
+            to_insert = [{"created_at": period_start, "user_id": user_id, "node_id": node_id, "used_traffic": value}
+                         for (user_id, node_id), value in sums.items() if (user_id, node_id) not in existings]
+            to_update = [{"record_id": existings[key], "value": value}
+                         for key, value in sums.items() if key in existings]
+
+            for i in range(0, len(to_insert), 1000):
+                db.execute(insert(target), to_insert[i:i + 1000])
+            if to_update:
+                db.execute(
+                    update(target)
+                    .where(target.c.id == bindparam("record_id"))
+                    .values(used_traffic=target.c.used_traffic + bindparam("value")),
+                    to_update,
+                )
+            db.execute(delete(source).where(period).execution_options(synchronize_session=False))
+            db.commit()
+
+
+def _user_usages_response(nodes: Dict[int, str],
+                          rows: List[tuple],
+                          granularity: Optional[UsageGranularity]) -> List[UserUsageResponse]:
+    if granularity:
+        return [
+            UserUsageResponse(node_id=node or None, node_name=nodes[node],
+                              used_traffic=used_traffic, period_start=period_start)
+            for node, period_start, used_traffic in rows if node in nodes
+        ]
+
+    usages = {node: UserUsageResponse(node_id=node or None, node_name=name, used_traffic=0)
+              for node, name in nodes.items()}
+    for node, _, used_traffic in rows:
+        if node in usages:
+            usages[node].used_traffic = used_traffic
     return list(usages.values())
 
 
+def get_user_usages(db: Session,
+                    dbuser: User,
+                    start: datetime,
+                    end: datetime,
+                    granularity: Optional[UsageGranularity] = None) -> List[UserUsageResponse]:
+    """
+    Retrieves user usages within a specified date range.
+
+    Args:
+        db (Session): Database session.
+        dbuser (User): The user object.
+        start (datetime): Start date for usage retrieval.
+        end (datetime): End date for usage retrieval.
+        granularity (Optional[UsageGranularity]): Groups the usages by hour, day or month too.
+
+    Returns:
+        List[UserUsageResponse]: List of user usage responses.
+    """
+    rows = _sum_user_usages(db, start, end, granularity, lambda query, model: query.filter(model.user_id == dbuser.id))
+    return _user_usages_response(_usage_nodes(db), rows, granularity)
+
+
 def get_users_count(db: Session, status: UserStatus = None, admin: Admin = None) -> int:
     """
     Retrieves the count of users based on status and admin filters.
@@ -400,6 +844,8 @@ def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
     db.add(dbuser)
     db.commit()
     db.refresh(dbuser)
+    users_search.add(dbuser)
+    user_admins.set(dbuser.id, dbuser.admin_id)
     return dbuser
 
 
@@ -416,6 +862,7 @@ def remove_user(db: Session, dbuser: User) -> User:
     """
     db.delete(dbuser)
     db.commit()
+    user_admins.discard(dbuser.id)
     return dbuser
 
 
@@ -430,6 +877,7 @@ def remove_users(db: Session, dbusers: List[User]):
     for dbuser in dbusers:
         db.delete(dbuser)
     db.commit()
+    user_admins.discard(*(dbuser.id for dbuser in dbusers))
     return
 
 
@@ -529,9 +977,124 @@ def update_user(db: Session, dbuser: User, modify: UserModify) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    if modify.note is not None:
+        users_search.add(dbuser)
     return dbuser
 
 
+def bulk_modify_users(db: Session,
+                      data_limit: int = 0,
+                      expire: int = 0,
+                      status: Optional[List[UserStatus]] = None,
+                      admins: Optional[List[str]] = None) -> Tuple[List[int], Dict[UserStatus, List[int]]]:
+    """
+    Adds to the data limits and expiry dates of users, and updates the statuses they change,
+    in a few set-based statements and a single transaction.
+
+    Args:
+        db (Session): Database session.
+        data_limit (int): Bytes added to the data limits of the users that have one,
+            negative values subtract (down to 0).
+        expire (int): Seconds added to the expiry dates of the users that have one, negative values subtract.
+        status (Optional[List[UserStatus]]): Only modify the users with these statuses.
+        admins (Optional[List[str]]): Only modify the users of these admins.
+
+    Returns:
+        Tuple[List[int], Dict[UserStatus, List[int]]]: IDs of the modified users,
+            and the IDs of those whose status changed, by their new status.
+    """
+    filters = []
+    if status:
+        filters.append(User.status.in_(status))
+    if admins:
+        filters.append(User.admin_id.in_(db.query(Admin.id).filter(Admin.username.in_(admins))))
+
+    modified = []
+    if data_limit:
+        modified.append(User.data_limit.isnot(None))
+    if expire:
+        modified.append(User.expire.isnot(None))
+    if not modified:
+        return [], {}
+
+    user_ids = [user_id for user_id, in db.query(User.id).filter(*filters, or_(*modified)).order_by(User.id)]
+    if not user_ids:
+        return [], {}
+
+    if data_limit:
+        db.query(User).filter(*filters, User.data_limit.isnot(None)).update(
+            {User.data_limit: case((User.data_limit + data_limit > 0, User.data_limit + data_limit), else_=0)},
+            synchronize_session=False
+        )
+    if expire:
+        db.query(User).filter(*filters, User.expire.isnot(None)).update(
+            {User.expire: User.expire + expire}, synchronize_session=False
+        )
+
+    now = datetime.utcnow()
+    now_ts = int(now.timestamp())
+
+    # reminders of the thresholds the users are back under can be sent again
+    if data_limit:
+        db.query(NotificationReminder).filter(
+            NotificationReminder.type == ReminderType.data_usage,
+            exists().where(
+                User.id == NotificationReminder.user_id, *filters, User.data_limit.isnot(None),
+                User.used_traffic * 100 < NotificationReminder.threshold * User.data_limit,
+            ),
+        ).delete(synchronize_session=False)
+    if expire:
+        db.query(NotificationReminder).filter(
+            NotificationReminder.type == ReminderType.expiration_date,
+            exists().where(
+                User.id == NotificationReminder.user_id, *filters, User.expire.isnot(None),
+                User.expire - now_ts >= (NotificationReminder.threshold + 1) * 86400,
+            ),
+        ).delete(synchronize_session=False)
+
+    within_limit = or_(User.data_limit.is_(None), User.used_traffic < User.data_limit)
+    not_expired = or_(User.expire.is_(None), User.expire > now_ts)
+    transitions = (
+        (UserStatus.limited, and_(User.status.in_((UserStatus.active, UserStatus.on_hold)), ~within_limit)),
+        (UserStatus.expired, and_(User.status == UserStatus.active, ~not_expired)),
+        (UserStatus.active, and_(User.status.in_((UserStatus.limited, UserStatus.expired)), within_limit, not_expired)),
+    )
+
+    changes = {}
+    for i in range(0, len(user_ids), 1000):
+        chunk = User.id.in_(user_ids[i:i + 1000])
+        for new_status, condition in transitions:
+            changed = [user_id for user_id, in db.query(User.id).filter(chunk, condition)]
+            if changed:
+                _update_users_status(db, changed, new_status)
+                changes.setdefault(new_status, []).extend(changed)
+
+    db.commit()
+    return user_ids, changes
+
+
+def iter_users(db: Session, user_ids: List[int], chunk_size: int = 1000, with_proxies: bool = False) -> Iterator[User]:
+    """
+    Yields users by their IDs, loading them a chunk at a time.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users.
+        chunk_size (int): Number of users loaded at a time.
+        with_proxies (bool): Load the proxies and excluded inbounds of the users along with them.
+
+    Yields:
+        User: The users, in the order of their IDs.
+    """
+    query = get_user_queryset(db)
+    if with_proxies:
+        query = query.options(selectinload(User.proxies).selectinload(Proxy.excluded_inbounds))
+
+    user_ids = sorted(user_ids)
+    for i in range(0, len(user_ids), chunk_size):
+        yield from query.filter(User.id.in_(user_ids[i:i + chunk_size])).order_by(User.id)
+
+
 def reset_user_data_usage(db: Session, dbuser: User) -> User:
     """
     Resets the data usage of a user and logs the reset.
@@ -551,6 +1114,8 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
 
     dbuser.used_traffic = 0
     dbuser.node_usages.clear()
+    dbuser.daily_node_usages.clear()
+    dbuser.monthly_node_usages.clear()
     if dbuser.status not in (UserStatus.expired or UserStatus.disabled):
         dbuser.status = UserStatus.active.value
 
@@ -586,6 +1151,8 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
     db.add(usage_log)
 
     dbuser.node_usages.clear()
+    dbuser.daily_node_usages.clear()
+    dbuser.monthly_node_usages.clear()
     dbuser.status = UserStatus.active.value
 
     dbuser.data_limit = dbuser.next_plan.data_limit + \
@@ -646,60 +1213,104 @@ def update_user_sub(db: Session, dbuser: User, user_agent: str) -> User:
     return dbuser
 
 
-def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None):
+def update_users_sub(db: Session, updates: Dict[int, Tuple[datetime, str]]):
+    """
+    Updates the subscription details of many users at once.
+
+    Args:
+        db (Session): Database session.
+        updates (Dict[int, Tuple[datetime, str]]): Time of the last subscription update and user agent by user ID.
+    """
+    stmt = update(User). \
+        where(User.id == bindparam('uid')). \
+        values(sub_updated_at=bindparam('updated_at'), sub_last_user_agent=bindparam('user_agent'))
+    params = [{"uid": uid, "updated_at": updated_at, "user_agent": user_agent}
+              for uid, (updated_at, user_agent) in sorted(updates.items())]
+
+    for i in range(0, len(params), 1000):
+        db.connection().execute(stmt, params[i:i + 1000])
+    db.commit()
+
+
+def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Resets the data usage for all users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the users who were limited and are active again.
     """
     query = get_user_queryset(db)
 
     if admin:
         query = query.filter(User.admin == admin)
 
+    activated = []
     for dbuser in query.all():
         dbuser.used_traffic = 0
         if dbuser.status not in [UserStatus.on_hold, UserStatus.expired, UserStatus.disabled]:
+            if dbuser.status != UserStatus.active:
+                activated.append(dbuser.id)
             dbuser.status = UserStatus.active
         dbuser.usage_logs.clear()
         dbuser.node_usages.clear()
+        dbuser.daily_node_usages.clear()
+        dbuser.monthly_node_usages.clear()
         if dbuser.next_plan:
             db.delete(dbuser.next_plan)
             dbuser.next_plan = None
         db.add(dbuser)
 
     db.commit()
+    return activated
+
 
+def _update_users_status(db: Session, user_ids: List[int], status: UserStatus):
+    now = datetime.utcnow()
+    for i in range(0, len(user_ids), 1000):
+        db.query(User).filter(User.id.in_(user_ids[i:i + 1000])).update(
+            {User.status: status, User.last_status_change: now}, synchronize_session=False
+        )
 
-def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
+
+def disable_all_active_users(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Disable all active users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the disabled users.
     """
-    query = db.query(User).filter(User.status.in_((UserStatus.active, UserStatus.on_hold)))
+    query = db.query(User.id).filter(User.status.in_((UserStatus.active, UserStatus.on_hold)))
     if admin:
         query = query.filter(User.admin == admin)
 
-    query.update({User.status: UserStatus.disabled, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
+    user_ids = [user_id for user_id, in query]
+    _update_users_status(db, user_ids, UserStatus.disabled)
 
     db.commit()
+    return user_ids
 
 
-def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
+def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Activate all disabled users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the activated (or on hold) users.
     """
-    query_for_active_users = db.query(User).filter(User.status == UserStatus.disabled)
-    query_for_on_hold_users = db.query(User).filter(
+    query_for_active_users = db.query(User.id).filter(User.status == UserStatus.disabled)
+    query_for_on_hold_users = db.query(User.id).filter(
         and_(
             User.status == UserStatus.disabled, User.expire.is_(
                 None), User.on_hold_expire_duration.isnot(None), User.online_at.is_(None)
@@ -708,12 +1319,13 @@ def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
         query_for_active_users = query_for_active_users.filter(User.admin == admin)
         query_for_on_hold_users = query_for_on_hold_users.filter(User.admin == admin)
 
-    query_for_on_hold_users.update(
-        {User.status: UserStatus.on_hold, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
-    query_for_active_users.update(
-        {User.status: UserStatus.active, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
+    on_hold_user_ids = [user_id for user_id, in query_for_on_hold_users]
+    _update_users_status(db, on_hold_user_ids, UserStatus.on_hold)
+    active_user_ids = [user_id for user_id, in query_for_active_users]
+    _update_users_status(db, active_user_ids, UserStatus.active)
 
     db.commit()
+    return on_hold_user_ids + active_user_ids
 
 
 def autodelete_expired_users(db: Session,
@@ -757,7 +1369,11 @@ def autodelete_expired_users(db: Session,
 
 
 def get_all_users_usages(
-        db: Session, admin: Admin, start: datetime, end: datetime
+        db: Session,
+        admin: Optional[List[str]],
+        start: datetime,
+        end: datetime,
+        granularity: Optional[UsageGranularity] = None,
 ) -> List[UserUsageResponse]:
     """
     Retrieves usage data for all users associated with an admin within a specified time range.
@@ -767,42 +1383,24 @@ def get_all_users_usages(
 
     Args:
         db (Session): Database session for querying.
-        admin (Admin): The admin user for which to retrieve user usage data.
+        admin (Optional[List[str]]): Usernames of the admins whose users' usages are summed, None for all users.
         start (datetime): The start date and time of the period to consider.
         end (datetime): The end date and time of the period to consider.
+        granularity (Optional[UsageGranularity]): Groups the usages by hour, day or month too.
 
     Returns:
         List[UserUsageResponse]: A list of UserUsageResponse objects, each representing
         the usage data for a specific node or the main core.
     """
-    usages = {0: UserUsageResponse(  # Main Core
-        node_id=None,
-        node_name="Master",
-        used_traffic=0
-    )}
-
-    for node in db.query(Node).all():
-        usages[node.id] = UserUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
-            used_traffic=0
+    def filter_admins(query: Query, model) -> Query:
+        if not admin:
+            return query
+        return query.join(User, User.id == model.user_id).filter(
+            User.admin_id.in_(db.query(Admin.id).filter(Admin.username.in_(admin)))
         )
 
-    admin_users = set(user.id for user in get_users(db=db, admins=admin))
-
-    cond = and_(
-        NodeUserUsage.created_at >= start,
-        NodeUserUsage.created_at <= end,
-        NodeUserUsage.user_id.in_(admin_users)
-    )
-
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
-
-    return list(usages.values())
+    rows = _sum_user_usages(db, start, end, granularity, filter_admins)
+    return _user_usages_response(_usage_nodes(db), rows, granularity)
 
 
 def update_user_status(db: Session, dbuser: User, status: UserStatus) -> User:
@@ -839,6 +1437,7 @@ def set_owner(db: Session, dbuser: User, admin: Admin) -> User:
     dbuser.admin = admin
     db.commit()
     db.refresh(dbuser)
+    user_admins.set(dbuser.id, dbuser.admin_id)
     return dbuser
 
 
@@ -1006,6 +1605,7 @@ def remove_admin(db: Session, dbadmin: Admin) -> Admin:
     """
     db.delete(dbadmin)
     db.commit()
+    user_admins.discard_admin(dbadmin.id)
     return dbadmin
 
 
@@ -1254,7 +1854,10 @@ def get_nodes(db: Session,
     return query.all()
 
 
-def get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsageResponse]:
+def get_nodes_usage(db: Session,
+                    start: datetime,
+                    end: datetime,
+                    granularity: Optional[UsageGranularity] = None) -> List[NodeUsageResponse]:
     """
     Retrieves usage data for all nodes within a specified time range.
 
@@ -1262,34 +1865,31 @@ def get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsa
         db (Session): The database session.
         start (datetime): The start time of the usage period.
         end (datetime): The end time of the usage period.
+        granularity (Optional[UsageGranularity]): Groups the usages by hour, day or month too.
 
     Returns:
         List[NodeUsageResponse]: A list of NodeUsageResponse objects containing usage data.
     """
-    usages = {0: NodeUsageResponse(  # Main Core
-        node_id=None,
-        node_name="Master",
-        uplink=0,
-        downlink=0
-    )}
-
-    for node in db.query(Node).all():
-        usages[node.id] = NodeUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
-            uplink=0,
-            downlink=0
-        )
-
-    cond = and_(NodeUsage.created_at >= start, NodeUsage.created_at <= end)
+    nodes = _usage_nodes(db)
+    query = db.query(func.sum(NodeUsage.uplink), func.sum(NodeUsage.downlink)).filter(
+        NodeUsage.created_at >= start,
+        NodeUsage.created_at <= end,
+    )
+    rows = _sum_usages(db, query, NodeUsage.created_at, NodeUsage.node_id, granularity)
 
-    for v in db.query(NodeUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].uplink += v.uplink
-            usages[v.node_id or 0].downlink += v.downlink
-        except KeyError:
-            pass
+    if granularity:
+        return [
+            NodeUsageResponse(node_id=node or None, node_name=nodes[node],
+                              uplink=uplink, downlink=downlink, period_start=period_start)
+            for node, period_start, uplink, downlink in rows if node in nodes
+        ]
 
+    usages = {node: NodeUsageResponse(node_id=node or None, node_name=name, uplink=0, downlink=0)
+              for node, name in nodes.items()}
+    for node, _, uplink, downlink in rows:
+        if node in usages:
+            usages[node].uplink = uplink
+            usages[node].downlink = downlink
     return list(usages.values())
 
 
@@ -0,0 +1,89 @@
+"""users search index
+
+Revision ID: 3d6f8b0c7a21
+Revises: 0225f2908e1a
+Create Date: 2026-10-18 18:21:07.118412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d6f8b0c7a21'
+down_revision = '0225f2908e1a'
+branch_labels = None
+depends_on = None
+
+
+# each database gets the index it supports, if it can't create one
+# the search uses an in-process index instead (see app/db/search.py)
+
+def upgrade_sqlite(bind) -> None:
+    # the trigram tokenizer needs SQLite 3.34.0 or newer, compiled with FTS5
+    try:
+        op.execute("CREATE VIRTUAL TABLE users_search USING fts5("
+                   "username, note, content='users', content_rowid='id', tokenize='trigram')")
+    except sa.exc.OperationalError:
+        return
+
+    op.execute("INSERT INTO users_search(users_search) VALUES ('rebuild')")
+    op.execute("CREATE TRIGGER users_search_insert AFTER INSERT ON users BEGIN "
+               "INSERT INTO users_search(rowid, username, note) VALUES (new.id, new.username, new.note); END")
+    op.execute("CREATE TRIGGER users_search_delete AFTER DELETE ON users BEGIN "
+               "INSERT INTO users_search(users_search, rowid, username, note) "
+               "VALUES ('delete', old.id, old.username, old.note); END")
+    op.execute("CREATE TRIGGER users_search_update AFTER UPDATE OF username, note ON users BEGIN "
+               "INSERT INTO users_search(users_search, rowid, username, note) "
+               "VALUES ('delete', old.id, old.username, old.note); "
+               "INSERT INTO users_search(rowid, username, note) VALUES (new.id, new.username, new.note); END")
+
+
+def upgrade_mysql(bind) -> None:
+    # the ngram parser drops every n-gram containing a stopword (e.g. "a" or "i"),
+    # the index is created without them so any substring can be found
+    # MariaDB doesn't have the ngram parser
+    try:
+        op.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+        op.execute("ALTER TABLE users ADD FULLTEXT INDEX ix_users_search (username, note) WITH PARSER ngram")
+    except (sa.exc.OperationalError, sa.exc.ProgrammingError):
+        pass
+
+
+def upgrade_postgresql(bind) -> None:
+    # creating the extension may need privileges the database user doesn't have
+    try:
+        with bind.begin_nested():
+            op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            op.execute("CREATE INDEX ix_users_search_username ON users USING gin (username gin_trgm_ops)")
+            op.execute("CREATE INDEX ix_users_search_note ON users USING gin (note gin_trgm_ops)")
+    except (sa.exc.OperationalError, sa.exc.ProgrammingError):
+        pass
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    upgrade_dialect = globals().get(f"upgrade_{bind.dialect.name}")
+    if upgrade_dialect:
+        upgrade_dialect(bind)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == "sqlite":
+        op.execute("DROP TRIGGER IF EXISTS users_search_update")
+        op.execute("DROP TRIGGER IF EXISTS users_search_delete")
+        op.execute("DROP TRIGGER IF EXISTS users_search_insert")
+        op.execute("DROP TABLE IF EXISTS users_search")
+
+    elif bind.dialect.name == "mysql":
+        exists = bind.execute(sa.text(
+            "SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() "
+            "AND table_name = 'users' AND index_name = 'ix_users_search'"
+        )).first()
+        if exists:
+            op.drop_index('ix_users_search', table_name='users')
+
+    elif bind.dialect.name == "postgresql":
+        op.execute("DROP INDEX IF EXISTS ix_users_search_note")
+        op.execute("DROP INDEX IF EXISTS ix_users_search_username")
@@ -0,0 +1,40 @@
+"""usage rollup tables
+
+Revision ID: 7c4e2a9d1f53
+Revises: 3d6f8b0c7a21
+Create Date: 2026-10-18 20:42:15.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4e2a9d1f53'
+down_revision = '3d6f8b0c7a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for period in ('daily', 'monthly'):
+        table_name = f'node_user_usages_{period}'
+        op.create_table(table_name,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('node_id', sa.Integer(), nullable=True),
+        sa.Column('used_traffic', sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(['node_id'], ['nodes.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('created_at', 'user_id', 'node_id')
+        )
+        op.create_index(f'ix_{table_name}_user_id_created_at', table_name, ['user_id', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    for period in ('daily', 'monthly'):
+        table_name = f'node_user_usages_{period}'
+        op.drop_index(f'ix_{table_name}_user_id_created_at', table_name=table_name)
+        op.drop_table(table_name)
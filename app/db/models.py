@@ -10,6 +10,7 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
@@ -60,6 +61,11 @@ class AdminUsageLogs(Base):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_status_expire", "status", "expire"),
+        Index("ix_users_status_on_hold_timeout", "status", "on_hold_timeout"),
+        Index("ix_users_admin_id_status", "admin_id", "status"),
+    )
 
     id = Column(Integer, primary_key=True)
     username = Column(String(34, collation='NOCASE'), unique=True, index=True)
@@ -67,6 +73,8 @@ class User(Base):
     status = Column(Enum(UserStatus), nullable=False, default=UserStatus.active)
     used_traffic = Column(BigInteger, default=0)
     node_usages = relationship("NodeUserUsage", back_populates="user", cascade="all, delete-orphan")
+    daily_node_usages = relationship("NodeUserUsageDaily", back_populates="user", cascade="all, delete-orphan")
+    monthly_node_usages = relationship("NodeUserUsageMonthly", back_populates="user", cascade="all, delete-orphan")
     notification_reminders = relationship("NotificationReminder", back_populates="user", cascade="all, delete-orphan")
     data_limit = Column(BigInteger, nullable=True)
     data_limit_reset_strategy = Column(
@@ -81,9 +89,9 @@ class User(Base):
     sub_revoked_at = Column(DateTime, nullable=True, default=None)
     sub_updated_at = Column(DateTime, nullable=True, default=None)
     sub_last_user_agent = Column(String(512), nullable=True, default=None)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     note = Column(String(500), nullable=True, default=None)
-    online_at = Column(DateTime, nullable=True, default=None)
+    online_at = Column(DateTime, nullable=True, default=None, index=True)
     on_hold_expire_duration = Column(BigInteger, nullable=True, default=None)
     on_hold_timeout = Column(DateTime, nullable=True, default=None)
 
@@ -148,7 +156,7 @@ class User(Base):
 excluded_inbounds_association = Table(
     "exclude_inbounds_association",
     Base.metadata,
-    Column("proxy_id", ForeignKey("proxies.id")),
+    Column("proxy_id", ForeignKey("proxies.id"), index=True),
     Column("inbound_tag", ForeignKey("inbounds.tag")),
 )
 
@@ -192,7 +200,7 @@ class UserUsageResetLogs(Base):
     __tablename__ = "user_usage_logs"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     user = relationship("User", back_populates="usage_logs")
     used_traffic_at_reset = Column(BigInteger, nullable=False)
     reset_at = Column(DateTime, default=datetime.utcnow)
@@ -202,7 +210,7 @@ class Proxy(Base):
     __tablename__ = "proxies"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     user = relationship("User", back_populates="proxies")
     type = Column(Enum(ProxyTypes), nullable=False)
     settings = Column(JSON, nullable=False)
@@ -307,6 +315,8 @@ class Node(Base):
     uplink = Column(BigInteger, default=0)
     downlink = Column(BigInteger, default=0)
     user_usages = relationship("NodeUserUsage", back_populates="node", cascade="all, delete-orphan")
+    daily_user_usages = relationship("NodeUserUsageDaily", back_populates="node", cascade="all, delete-orphan")
+    monthly_user_usages = relationship("NodeUserUsageMonthly", back_populates="node", cascade="all, delete-orphan")
     usages = relationship("NodeUsage", back_populates="node", cascade="all, delete-orphan")
     usage_coefficient = Column(Float, nullable=False, server_default=text("1.0"), default=1)
 
@@ -315,6 +325,7 @@ class NodeUserUsage(Base):
     __tablename__ = "node_user_usages"
     __table_args__ = (
         UniqueConstraint('created_at', 'user_id', 'node_id'),
+        Index('ix_node_user_usages_user_id_created_at', 'user_id', 'created_at'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -326,6 +337,38 @@ class NodeUserUsage(Base):
     used_traffic = Column(BigInteger, default=0)
 
 
+class NodeUserUsageDaily(Base):
+    __tablename__ = "node_user_usages_daily"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+        Index('ix_node_user_usages_daily_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one day per record
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="daily_node_usages")
+    node_id = Column(Integer, ForeignKey("nodes.id"))
+    node = relationship("Node", back_populates="daily_user_usages")
+    used_traffic = Column(BigInteger, default=0)
+
+
+class NodeUserUsageMonthly(Base):
+    __tablename__ = "node_user_usages_monthly"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+        Index('ix_node_user_usages_monthly_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one month per record
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="monthly_node_usages")
+    node_id = Column(Integer, ForeignKey("nodes.id"))
+    node = relationship("Node", back_populates="monthly_user_usages")
+    used_traffic = Column(BigInteger, default=0)
+
+
 class NodeUsage(Base):
     __tablename__ = "node_usages"
     __table_args__ = (
@@ -342,6 +385,9 @@ class NodeUsage(Base):
 
 class NotificationReminder(Base):
     __tablename__ = "notification_reminders"
+    __table_args__ = (
+        Index("ix_notification_reminders_user_id_type_threshold", "user_id", "type", "threshold"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
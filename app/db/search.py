@@ -0,0 +1,205 @@
+"""
+Substring search of the users' usernames and notes.
+
+The search is looked up in the index the database has for it (see the
+"users search index" migration): an FTS5 trigram table on SQLite, an ngram
+full-text index on MySQL (created without stopwords, which the ngram parser
+would drop every n-gram containing) or trigram GIN indexes on PostgreSQL.
+Databases that couldn't create one (e.g. MariaDB or an old SQLite) use an
+in-process trigram index instead. Either way, the candidates are checked with
+ILIKE, so the results are the same as scanning the users, except that the
+in-process index may miss the changes other processes made to existing users
+for up to TRIGRAM_INDEX_MAX_AGE seconds.
+"""
+
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, column, false, or_, select, table, text
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from app.db.models import User
+
+# the indexes work on trigrams, shorter searches scan the users
+MIN_SEARCH_LENGTH = 3
+# with more candidates than this, scanning the users is cheaper than looking them up by IDs
+MAX_CANDIDATES = 5000
+# postings longer than this aren't intersected, the ILIKE check filters what they'd have removed
+MAX_INTERSECTED_POSTING = 100000
+# the in-process index is loaded again after this many seconds, for the notes changed by other processes
+TRIGRAM_INDEX_MAX_AGE = 3600
+
+FTS5 = "fts5"
+NGRAM = "ngram"
+TRIGRAM = "trigram"
+IN_PROCESS = "in_process"
+
+users_search_table = table("users_search", column("rowid"))
+
+
+class TrigramIndex:
+    """
+    In-process index of the users' IDs by the trigrams of their usernames and notes.
+
+    It's loaded on the first search and IDs are only appended to it afterwards,
+    so it may return users that were deleted or whose note changed since,
+    which the ILIKE check filters out. Each search first indexes the users
+    created since, by any process, and the whole index is loaded again every
+    ``TRIGRAM_INDEX_MAX_AGE`` seconds.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        self._max_id = 0  # users with greater IDs aren't indexed yet
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def trigrams(value: str) -> set:
+        value = value.lower()
+        return {value[i:i + 3] for i in range(len(value) - 2)}
+
+    def _add(self, user_id: int, *values: Optional[str]):
+        for value in values:
+            if value:
+                for trigram in self.trigrams(value):
+                    posting = self._postings.get(trigram)
+                    if posting is None:
+                        posting = self._postings[trigram] = array("I")
+                    posting.append(user_id)
+
+    def add(self, user: User):
+        # new users are indexed by the next search
+        with self._lock:
+            if user.id <= self._max_id:
+                self._add(user.id, user.username, user.note)
+
+    def candidates(self, db: Session, search: str) -> Optional[set]:
+        """Returns the IDs of the users that may match, or None if there are too many of them."""
+        with self._lock:
+            if time.monotonic() > self._expires_at:
+                self._postings = {}
+                self._max_id = 0
+                self._expires_at = time.monotonic() + TRIGRAM_INDEX_MAX_AGE
+
+            query = db.query(User.id, User.username, User.note).filter(User.id > self._max_id).order_by(User.id)
+            for user_id, username, note in query.yield_per(10000):
+                self._add(user_id, username, note)
+                self._max_id = user_id
+
+            postings = sorted((self._postings.get(t, ()) for t in self.trigrams(search)), key=len)
+
+        if len(postings[0]) > MAX_CANDIDATES:
+            return None
+
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates or len(posting) > MAX_INTERSECTED_POSTING:
+                break
+            candidates.intersection_update(posting)
+
+        return candidates
+
+
+class UsersSearch:
+    def __init__(self):
+        self.backend: Optional[str] = None
+        self.ngram_token_size = 2
+        self.trigrams = TrigramIndex()
+
+    def _detect_backend(self, db: Session) -> str:
+        dialect = db.bind.dialect.name
+        if dialect == "sqlite":
+            query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'"
+            backend = FTS5
+        elif dialect == "mysql":
+            query = ("SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                     "AND table_name = 'users' AND index_name = 'ix_users_search'")
+            backend = NGRAM
+        elif dialect == "postgresql":
+            query = "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_users_search_username'"
+            backend = TRIGRAM
+        else:
+            return IN_PROCESS
+
+        if not db.execute(text(query)).first():
+            return IN_PROCESS
+
+        if backend == NGRAM:
+            self.ngram_token_size = db.execute(text("SELECT @@ngram_token_size")).scalar()
+        return backend
+
+    def add(self, user: User):
+        """Indexes a created or modified user, when the in-process index is used."""
+        if self.backend == IN_PROCESS:
+            self.trigrams.add(user)
+
+    def _candidates(self, db: Session, search: str) -> Optional[set]:
+        if self.backend == FTS5:
+            phrase = '"' + search.replace('"', '""') + '"'
+            ids = db.execute(
+                select(users_search_table.c.rowid)
+                .where(text("users_search MATCH :phrase").bindparams(phrase=phrase))
+                .limit(MAX_CANDIDATES + 1)
+            ).scalars().all()
+            return set(ids) if len(ids) <= MAX_CANDIDATES else None
+
+        if self.backend == IN_PROCESS:
+            return self.trigrams.candidates(db, search)
+
+        return None
+
+    def clause(self, db: Session, search: str) -> Tuple:
+        """
+        Returns the clause of the users whose username or note contains ``search``,
+        and whether it narrows them down to a few IDs that were found in an index.
+        """
+        like = or_(User.username.icontains(search, autoescape=True), User.note.icontains(search, autoescape=True))
+        if len(search) < MIN_SEARCH_LENGTH:
+            return like, False
+
+        if self.backend is None:
+            self.backend = self._detect_backend(db)
+
+        if self.backend == NGRAM:
+            # searches shorter than an n-gram, or with whitespace (never indexed) or quotes, scan the users
+            if len(search) < self.ngram_token_size or any(c.isspace() or c == '"' for c in search):
+                return like, False
+            return and_(match(User.username, User.note, against=f'"{search}"').in_boolean_mode(), like), False
+
+        # too broad searches are cheaper to find by scanning the users,
+        # the trigram indexes of PostgreSQL are used by ILIKE itself
+        candidates = self._candidates(db, search)
+        if candidates is None:
+            return like, False
+        if not candidates:
+            return false(), True
+        return and_(User.id.in_(candidates), like), True
+
+    @staticmethod
+    def order(db: Session, clauses: List[UnaryExpression]) -> List[UnaryExpression]:
+        """
+        Returns the ORDER BY clauses to use when the clause of a search narrows the users down.
+
+        SQLite prefers scanning the index of a sort key (or the rowids) to avoid sorting,
+        instead of looking up the few users the search matched, which reads every user.
+        A unary ``+`` keeps it from using an index for the order.
+        """
+        if db.bind.dialect.name != "sqlite":
+            return clauses
+
+        plus = operators.custom_op("+")
+        return [
+            UnaryExpression(clause.element, operator=plus, type_=clause.element.type).desc()
+            if clause.modifier is operators.desc_op else
+            UnaryExpression(clause.element, operator=plus, type_=clause.element.type).asc()
+            for clause in clauses
+        ]
+
+
+users_search = UsersSearch()
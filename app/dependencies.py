@@ -72,7 +72,7 @@ def get_validated_sub(
     if not sub:
         raise HTTPException(status_code=404, detail="Not Found")
 
-    dbuser = crud.get_user(db, sub['username'])
+    dbuser = crud.get_user_for_subscription(db, sub['username'])
     if not dbuser or dbuser.created_at > sub['created_at']:
         raise HTTPException(status_code=404, detail="Not Found")
 
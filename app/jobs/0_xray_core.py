@@ -1,5 +1,6 @@
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from app import app, logger, scheduler, xray
 from app.db import GetDB, crud
@@ -9,29 +10,28 @@ from xray_api import exc as xray_exc
 
 
 def core_health_check():
-    config = None
-
     # main core
     if not xray.core.started:
-        if not config:
-            config = xray.config.include_db_users()
-        xray.core.restart(config)
+        xray.core.restart(xray.config.include_db_users())
 
     # nodes' core
-    for node_id, node in list(xray.nodes.items()):
+    nodes = list(xray.nodes.items())
+
+    # refresh the nodes' state in parallel, everything else reads it from memory
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        for node_id, node in nodes:
+            executor.submit(node.heartbeat)
+
+    for node_id, node in nodes:
         if node.connected:
             try:
                 assert node.started
                 node.api.get_sys_stats(timeout=2)
             except (ConnectionError, xray_exc.XrayError, AssertionError):
-                if not config:
-                    config = xray.config.include_db_users()
-                xray.operations.restart_node(node_id, config)
+                xray.operations.restart_node(node_id)
 
         if not node.connected:
-            if not config:
-                config = xray.config.include_db_users()
-            xray.operations.connect_node(node_id, config)
+            xray.operations.connect_node(node_id)
 
 
 @app.on_event("startup")
@@ -58,7 +58,7 @@ def start_core():
             crud.update_node_status(db, dbnode, NodeStatus.connecting)
 
     for node_id in node_ids:
-        xray.operations.connect_node(node_id, config)
+        xray.operations.connect_node(node_id)
 
     scheduler.add_job(core_health_check, 'interval',
                       seconds=JOB_CORE_HEALTH_CHECK_INTERVAL,
@@ -0,0 +1,30 @@
+from app import app, logger, scheduler
+from app.db import GetDB, crud
+from app.subscription.updates import sub_updates
+from config import JOB_RECORD_SUB_UPDATES_INTERVAL
+
+
+def record_sub_updates():
+    updates = sub_updates.pop()
+    if not updates:
+        return
+
+    try:
+        with GetDB() as db:
+            crud.update_users_sub(db, updates)
+    except Exception:
+        sub_updates.restore(updates)
+        raise
+
+
+scheduler.add_job(record_sub_updates, 'interval',
+                  seconds=JOB_RECORD_SUB_UPDATES_INTERVAL,
+                  coalesce=True, max_instances=1)
+
+
+@app.on_event("shutdown")
+def record_remaining_sub_updates():
+    try:
+        record_sub_updates()
+    except Exception as err:
+        logger.error(f"Unable to record users' subscription updates: {err}")
@@ -1,110 +1,171 @@
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from operator import attrgetter
-from typing import Union
-
-from pymysql.err import OperationalError
-from sqlalchemy import and_, bindparam, insert, select, update
+from operator import attrgetter, itemgetter
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import Connection, Table, and_, bindparam, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
-from sqlalchemy.sql.dml import Insert
 
-from app import scheduler, xray
+from app import app, logger, scheduler, xray
 from app.db import GetDB
-from app.db.models import Admin, NodeUsage, NodeUserUsage, System, User
+from app.db.models import Admin, Node, NodeUsage, NodeUserUsage, System, User
+from app.utils.usage import (
+    current_hour,
+    user_admins,
+    user_usages,
+    user_usages_write_lock,
+    users_last_seen,
+    users_to_review,
+)
+from app.xray.collector import StatsCollector
 from config import (
     DISABLE_RECORDING_NODE_USAGE,
+    JOB_FLUSH_USER_USAGES_INTERVAL,
     JOB_RECORD_NODE_USAGES_INTERVAL,
+    JOB_RECORD_USAGES_NODE_DEADLINE,
     JOB_RECORD_USER_USAGES_INTERVAL,
 )
 from xray_api import XRay as XRayAPI
 from xray_api import exc as xray_exc
 
+# maximum number of rows sent to the database in a single statement
+UPSERT_CHUNK_SIZE = 1000
+
+
+def chunked(params: list, size: int = UPSERT_CHUNK_SIZE):
+    for i in range(0, len(params), size):
+        yield params[i:i + size]
+
+
+def safe_transaction(db: Session, writer: Callable[[Connection], None]):
+    """
+    Runs every statement of ``writer`` in a single transaction and commits it.
+    On MySQL the whole transaction is retried when it's picked as a deadlock victim.
+    """
+    tries = 0
+    while True:
+        try:
+            writer(db.connection())
+            db.commit()
+            return
+        except OperationalError as err:
+            db.rollback()
+            if db.bind.name == 'mysql' and err.orig.args[0] == 1213 and tries < 3:  # Deadlock
+                tries += 1
+                continue
+            raise err
 
-def safe_execute(db: Session, stmt, params=None):
-    if db.bind.name == 'mysql':
-        if isinstance(stmt, Insert):
-            stmt = stmt.prefix_with('IGNORE')
 
-        tries = 0
-        done = False
-        while not done:
-            try:
-                db.connection().execute(stmt, params)
-                db.commit()
-                done = True
-            except OperationalError as err:
-                if err.args[0] == 1213 and tries < 3:  # Deadlock
-                    db.rollback()
-                    tries += 1
-                    continue
-                raise err
+def existing_ids(conn: Connection, column, ids) -> set:
+    """Returns the ids of ``ids`` that are still in the table of ``column``."""
+    found = set()
+    for chunk in chunked(sorted(ids)):
+        found.update(conn.execute(select(column).where(column.in_(chunk))).scalars())
+    return found
 
-    else:
-        db.connection().execute(stmt, params)
-        db.commit()
 
+def upsert_stmt(conn: Connection, table: Table, index_elements: List[str], increments: List[str]):
+    """
+    Builds an INSERT which adds the inserted values of ``increments`` columns
+    to the existing row instead of failing when ``index_elements`` collide.
+    """
+    if conn.dialect.name == 'mysql':
+        stmt = mysql_insert(table)
+        return stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in increments})
 
-def record_user_stats(params: list, node_id: Union[int, None],
-                      consumption_factor: int = 1):
+    if conn.dialect.name == 'postgresql':
+        stmt = postgresql_insert(table)
+    else:
+        stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={c: table.c[c] + stmt.excluded[c] for c in increments}
+    )
+
+
+def record_user_stats(conn: Connection, params: list, created_at: datetime):
+    """
+    Records the per node usage of users, ``params`` items are
+    ``{"user_id": int, "node_id": Union[int, None], "used_traffic": int}``.
+    """
     if not params:
         return
 
-    created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
-
-    with GetDB() as db:
-        # make user usage row if doesn't exist
-        select_stmt = select(NodeUserUsage.user_id) \
-            .where(and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at))
-        existings = [r[0] for r in db.execute(select_stmt).fetchall()]
-        uids_to_insert = set()
-
-        for p in params:
-            uid = int(p['uid'])
-            if uid in existings:
-                continue
-            uids_to_insert.add(uid)
-
-        if uids_to_insert:
-            stmt = insert(NodeUserUsage).values(
-                user_id=bindparam('uid'),
-                created_at=created_at,
-                node_id=node_id,
-                used_traffic=0
-            )
-            safe_execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
-
-        # record
-        stmt = update(NodeUserUsage) \
-            .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value') * consumption_factor) \
-            .where(and_(NodeUserUsage.user_id == bindparam('uid'),
-                        NodeUserUsage.node_id == node_id,
-                        NodeUserUsage.created_at == created_at))
-        safe_execute(db, stmt, params)
-
-
-def record_node_stats(params: dict, node_id: Union[int, None]):
+    # users and nodes may have been removed since their usage was polled
+    user_ids = existing_ids(conn, User.id, {p['user_id'] for p in params})
+    node_ids = existing_ids(conn, Node.id, {p['node_id'] for p in params if p['node_id'] is not None})
+    params = [p for p in params if p['user_id'] in user_ids and (p['node_id'] is None or p['node_id'] in node_ids)]
+
+    table = NodeUserUsage.__table__
+    # NULL values never collide in a unique constraint, so the usages of
+    # the main core (node_id is NULL) can't be upserted and are merged by hand
+    main_params = [p for p in params if p['node_id'] is None]
+    nodes_params = sorted(({**p, 'created_at': created_at} for p in params if p['node_id'] is not None),
+                          key=itemgetter('node_id', 'user_id'))
+
+    if nodes_params:
+        stmt = upsert_stmt(conn, table, ['created_at', 'user_id', 'node_id'], ['used_traffic'])
+        for chunk in chunked(nodes_params):
+            conn.execute(stmt, chunk)
+
+    if main_params:
+        select_stmt = select(table.c.user_id) \
+            .where(and_(table.c.node_id.is_(None), table.c.created_at == created_at))
+        existings = set(r[0] for r in conn.execute(select_stmt))
+
+        to_insert = [{'user_id': p['user_id'], 'used_traffic': p['used_traffic']}
+                     for p in main_params if p['user_id'] not in existings]
+        to_update = sorted(({'uid': p['user_id'], 'value': p['used_traffic']}
+                            for p in main_params if p['user_id'] in existings), key=itemgetter('uid'))
+
+        if to_insert:
+            stmt = insert(table).values(created_at=created_at, node_id=None)
+            for chunk in chunked(to_insert):
+                conn.execute(stmt, chunk)
+
+        if to_update:
+            stmt = update(table) \
+                .values(used_traffic=table.c.used_traffic + bindparam('value')) \
+                .where(and_(table.c.user_id == bindparam('uid'),
+                            table.c.node_id.is_(None),
+                            table.c.created_at == created_at))
+            for chunk in chunked(to_update):
+                conn.execute(stmt, chunk)
+
+
+def record_node_stats(conn: Connection, params: list, created_at: datetime):
+    """
+    Records the outbound usage of nodes, ``params`` items are
+    ``{"node_id": Union[int, None], "uplink": int, "downlink": int}``.
+    """
     if not params:
         return
 
-    created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
+    # nodes may have been removed since their usage was polled
+    node_ids = existing_ids(conn, Node.id, {p['node_id'] for p in params if p['node_id'] is not None})
+    params = [p for p in params if p['node_id'] is None or p['node_id'] in node_ids]
 
-    with GetDB() as db:
-
-        # make node usage row if doesn't exist
-        select_stmt = select(NodeUsage.node_id). \
-            where(and_(NodeUsage.node_id == node_id, NodeUsage.created_at == created_at))
-        notfound = db.execute(select_stmt).first() is None
-        if notfound:
-            stmt = insert(NodeUsage).values(created_at=created_at, node_id=node_id, uplink=0, downlink=0)
-            safe_execute(db, stmt)
+    table = NodeUsage.__table__
+    main_params = [p for p in params if p['node_id'] is None]
+    nodes_params = sorted(({**p, 'created_at': created_at} for p in params if p['node_id'] is not None),
+                          key=itemgetter('node_id'))
 
-        # record
-        stmt = update(NodeUsage). \
-            values(uplink=NodeUsage.uplink + bindparam('up'), downlink=NodeUsage.downlink + bindparam('down')). \
-            where(and_(NodeUsage.node_id == node_id, NodeUsage.created_at == created_at))
+    if nodes_params:
+        stmt = upsert_stmt(conn, table, ['created_at', 'node_id'], ['uplink', 'downlink'])
+        conn.execute(stmt, nodes_params)
 
-        safe_execute(db, stmt, params)
+    for p in main_params:
+        result = conn.execute(
+            update(table)
+            .values(uplink=table.c.uplink + p['uplink'], downlink=table.c.downlink + p['downlink'])
+            .where(and_(table.c.node_id.is_(None), table.c.created_at == created_at))
+        )
+        if not result.rowcount:
+            conn.execute(insert(table).values(created_at=created_at, **p))
 
 
 def get_users_stats(api: XRayAPI):
@@ -127,99 +188,164 @@ def get_outbounds_stats(api: XRayAPI):
         return []
 
 
-def record_user_usages():
+def get_api_instances() -> Dict[Optional[int], XRayAPI]:
     api_instances = {None: xray.api}
-    usage_coefficient = {None: 1}  # default usage coefficient for the main api instance
-
     for node_id, node in list(xray.nodes.items()):
         if node.connected and node.started:
             api_instances[node_id] = node.api
-            usage_coefficient[node_id] = node.usage_coefficient  # fetch the usage coefficient
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_users_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
-
-    users_usage = defaultdict(int)
-    for node_id, params in api_params.items():
-        coefficient = usage_coefficient.get(node_id, 1)  # get the usage coefficient for the node
-        for param in params:
-            users_usage[param['uid']] += int(param['value'] * coefficient)  # apply the usage coefficient
-    users_usage = list({"uid": uid, "value": value} for uid, value in users_usage.items())
-    if not users_usage:
-        return
-
-    with GetDB() as db:
-        user_admin_map = dict(db.query(User.id, User.admin_id).all())
-
-    admin_usage = defaultdict(int)
-    for user_usage in users_usage:
-        admin_id = user_admin_map.get(int(user_usage["uid"]))
-        if admin_id:
-            admin_usage[admin_id] += user_usage["value"]
-
-    # record users usage
-    with GetDB() as db:
-        stmt = update(User). \
-            where(User.id == bindparam('uid')). \
-            values(
-                used_traffic=User.used_traffic + bindparam('value'),
-                online_at=datetime.utcnow()
-        )
+    return api_instances
 
-        safe_execute(db, stmt, users_usage)
 
-        admin_data = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
-        if admin_data:
-            admin_update_stmt = update(Admin). \
-                where(Admin.id == bindparam('admin_id')). \
-                values(users_usage=Admin.users_usage + bindparam('value'))
-            safe_execute(db, admin_update_stmt, admin_data)
-
-    if DISABLE_RECORDING_NODE_USAGE:
-        return
+def record_user_usages():
+    api_params = users_stats_collector.collect(get_api_instances(), JOB_RECORD_USAGES_NODE_DEADLINE)
 
     for node_id, params in api_params.items():
-        record_user_stats(params, node_id, usage_coefficient[node_id])
+        if node_id is None:
+            coefficient = 1  # default usage coefficient for the main api instance
+        elif node_id in xray.nodes:
+            coefficient = xray.nodes[node_id].usage_coefficient
+        else:
+            continue  # the node is removed
+        user_usages.add(node_id, {
+            int(param['uid']): int(param['value'] * coefficient)  # apply the usage coefficient
+            for param in params
+        })
+
+
+def flush_user_usages():
+    with user_usages.flush() as buckets:
+        if not buckets:
+            return
+
+        node_ids = {node_id for node_id, _ in buckets if node_id}
+        with GetDB() as db:
+            user_admin_map = user_admins.get_many(db, set().union(*buckets.values()))
+            if node_ids:
+                node_ids = set(db.execute(select(Node.id).where(Node.id.in_(node_ids))).scalars())
+
+        # the usages of users removed since they were polled are dropped,
+        # those on removed nodes still count for the users but aren't recorded per node
+        users_usage = defaultdict(int)
+        node_users_usage = defaultdict(list)
+        for (node_id, hour), usages in buckets.items():
+            created_at = datetime.utcfromtimestamp(hour)
+            for uid, value in usages.items():
+                if uid not in user_admin_map:
+                    continue
+                users_usage[uid] += value
+                if not node_id or node_id in node_ids:
+                    node_users_usage[created_at].append(
+                        {"user_id": uid, "node_id": node_id or None, "used_traffic": value})
+        if not users_usage:
+            return
+
+        admin_usage = defaultdict(int)
+        for uid, value in users_usage.items():
+            admin_id = user_admin_map.get(uid)
+            if admin_id:
+                admin_usage[admin_id] += value
+
+        now = datetime.utcnow()
+        online_users = users_last_seen.add(users_usage, now)
+
+        # rows are written in primary key order so concurrent transactions lock them in the same order
+        users_data = [{"uid": uid, "value": value} for uid, value in sorted(users_usage.items())
+                      if uid not in online_users]
+        online_users_data = [{"uid": uid, "value": value} for uid, value in sorted(users_usage.items())
+                             if uid in online_users]
+        admins_data = [{"admin_id": admin_id, "value": value} for admin_id, value in sorted(admin_usage.items())]
+
+        def write(conn: Connection):
+            # online_at is only written when it moved forward enough, it's indexed
+            stmt = update(User). \
+                where(User.id == bindparam('uid')). \
+                values(used_traffic=User.used_traffic + bindparam('value'))
+            for chunk in chunked(users_data):
+                conn.execute(stmt, chunk)
+
+            stmt = stmt.values(online_at=now)
+            for chunk in chunked(online_users_data):
+                conn.execute(stmt, chunk)
+
+            if admins_data:
+                admin_update_stmt = update(Admin). \
+                    where(Admin.id == bindparam('admin_id')). \
+                    values(users_usage=Admin.users_usage + bindparam('value'))
+                conn.execute(admin_update_stmt, admins_data)
+
+            if not DISABLE_RECORDING_NODE_USAGE:
+                for created_at, params in sorted(node_users_usage.items()):
+                    record_user_stats(conn, params, created_at)
+
+        with GetDB() as db, user_usages_write_lock:
+            try:
+                safe_transaction(db, write)
+            except IntegrityError as err:
+                # retrying wouldn't help, so the batch is dropped instead of being kept in the journal forever
+                db.rollback()
+                logger.error(f"Unable to record users' usages, they're dropped: {err}")
+                return
 
+        users_last_seen.written(online_users, now)
+        users_to_review.add(*users_usage)
 
-def record_node_usages():
-    api_instances = {None: xray.api}
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected and node.started:
-            api_instances[node_id] = node.api
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_outbounds_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
+def record_node_usages():
+    api_params = outbounds_stats_collector.collect(get_api_instances(), JOB_RECORD_USAGES_NODE_DEADLINE)
 
     total_up = 0
     total_down = 0
+    nodes_usage = []
     for node_id, params in api_params.items():
-        for param in params:
-            total_up += param['up']
-            total_down += param['down']
+        if node_id is not None and node_id not in xray.nodes:
+            continue  # the node is removed
+        up = sum(param['up'] for param in params)
+        down = sum(param['down'] for param in params)
+        if up or down:
+            nodes_usage.append({"node_id": node_id, "uplink": up, "downlink": down})
+        total_up += up
+        total_down += down
     if not (total_up or total_down):
         return
 
-    # record nodes usage
-    with GetDB() as db:
-        stmt = update(System).values(
+    created_at = current_hour()
+
+    def write(conn: Connection):
+        # record nodes usage
+        conn.execute(update(System).values(
             uplink=System.uplink + total_up,
             downlink=System.downlink + total_down
-        )
-        safe_execute(db, stmt)
+        ))
 
-    if DISABLE_RECORDING_NODE_USAGE:
-        return
+        if not DISABLE_RECORDING_NODE_USAGE:
+            record_node_stats(conn, nodes_usage, created_at)
+
+    with GetDB() as db:
+        safe_transaction(db, write)
 
-    for node_id, params in api_params.items():
-        record_node_stats(params, node_id)
 
+users_stats_collector = StatsCollector("users", get_users_stats)
+outbounds_stats_collector = StatsCollector("outbounds", get_outbounds_stats)
 
 scheduler.add_job(record_user_usages, 'interval',
                   seconds=JOB_RECORD_USER_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
+scheduler.add_job(flush_user_usages, 'interval',
+                  seconds=JOB_FLUSH_USER_USAGES_INTERVAL,
+                  coalesce=True, max_instances=1)
 scheduler.add_job(record_node_usages, 'interval',
                   seconds=JOB_RECORD_NODE_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
+
+
+@app.on_event("startup")
+def recover_user_usages():
+    user_usages.recover()
+
+
+@app.on_event("shutdown")
+def flush_remaining_user_usages():
+    try:
+        flush_user_usages()
+    except Exception as err:
+        logger.error(f"Unable to flush users' usages, they're kept in the journal: {err}")
@@ -1,21 +1,26 @@
+import time
 from datetime import datetime
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
 
 from sqlalchemy.orm import Session
 
 from app import logger, scheduler, xray
-from app.db import (GetDB, get_notification_reminder, get_users,
-                    start_user_expire, update_user_status, reset_user_by_next)
+from app.db import (GetDB, get_notification_reminder, get_users_expiring_between,
+                    get_users_to_review, start_user_expire, update_user_status, reset_user_by_next)
 from app.models.user import ReminderType, UserResponse, UserStatus
 from app.utils import report
 from app.utils.helpers import (calculate_expiration_days,
                                calculate_usage_percent)
+from app.utils.usage import users_last_seen, users_to_review
 from config import (JOB_REVIEW_USERS_INTERVAL, NOTIFY_DAYS_LEFT,
                     NOTIFY_REACHED_USAGE_PERCENT, WEBHOOK_ADDRESS)
 
 if TYPE_CHECKING:
     from app.db.models import User
 
+# timestamp of the last successful review
+last_review_ts: Optional[float] = None
+
 
 def add_notification_reminders(db: Session, user: "User", now: datetime = datetime.utcnow()) -> None:
     if user.data_limit:
@@ -51,68 +56,110 @@ def reset_user_by_next_report(db: Session, user: "User"):
     report.user_data_reset_by_next(user=UserResponse.model_validate(user), user_admin=user.admin)
 
 
-def review():
-    now = datetime.utcnow()
-    now_ts = now.timestamp()
-    with GetDB() as db:
-        for user in get_users(db, status=UserStatus.active):
-
-            limited = user.data_limit and user.used_traffic >= user.data_limit
-            expired = user.expire and user.expire <= now_ts
-
-            if (limited or expired) and user.next_plan is not None:
-                if user.next_plan is not None:
-
-                    if user.next_plan.fire_on_either:
-                        reset_user_by_next_report(db, user)
-                        continue
-
-                    elif limited and expired:
-                        reset_user_by_next_report(db, user)
-                        continue
-
-            if limited:
-                status = UserStatus.limited
-            elif expired:
-                status = UserStatus.expired
-            else:
-                if WEBHOOK_ADDRESS:
-                    add_notification_reminders(db, user, now)
-                continue
-
-            xray.operations.remove_user(user)
-            update_user_status(db, user, status)
+def get_reminder_candidates(db: Session, start_ts: float, end_ts: float) -> List["User"]:
+    """Active users whose days left reached one of NOTIFY_DAYS_LEFT between the two timestamps."""
+    users = {}
+    for days_left in NOTIFY_DAYS_LEFT:
+        # calculate_expiration_days() drops to days_left once the expiration is less than days_left + 1 days away
+        offset = (days_left + 1) * 86400
+        for user in get_users_expiring_between(db, UserStatus.active, start_ts + offset, end_ts + offset):
+            users[user.id] = user
+    return list(users.values())
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
-
-        for user in get_users(db, status=UserStatus.on_hold):
-
-            if user.edit_at:
-                base_time = datetime.timestamp(user.edit_at)
-            else:
-                base_time = datetime.timestamp(user.created_at)
-
-            # Check if the user is online After or at 'base_time'
-            if user.online_at and base_time <= datetime.timestamp(user.online_at):
-                status = UserStatus.active
-
-            elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now_ts)):
-                # If the user didn't connect within the timeout period, change status to "Active"
-                status = UserStatus.active
-
-            else:
-                continue
-
-            update_user_status(db, user, status)
-            start_user_expire(db, user)
-
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
+def review():
+    global last_review_ts
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
+    now = datetime.utcnow()
+    now_ts = now.timestamp()
+    start_time = time.time()
+
+    # only users whose usage moved or who were modified since the last review, and users
+    # whose expiration/timeout has passed, need to be checked; None means checking everyone
+    user_ids = users_to_review.pop()
+    try:
+        with GetDB() as db:
+            active_users = get_users_to_review(db, UserStatus.active, user_ids, expire_before=now_ts)
+            on_hold_users = get_users_to_review(db, UserStatus.on_hold, user_ids, on_hold_timeout_before=now)
+            evaluated = len(active_users) + len(on_hold_users)
+
+            for user in active_users:
+
+                limited = user.data_limit and user.used_traffic >= user.data_limit
+                expired = user.expire and user.expire <= now_ts
+
+                if (limited or expired) and user.next_plan is not None:
+                    if user.next_plan is not None:
+
+                        if user.next_plan.fire_on_either:
+                            reset_user_by_next_report(db, user)
+                            continue
+
+                        elif limited and expired:
+                            reset_user_by_next_report(db, user)
+                            continue
+
+                if limited:
+                    status = UserStatus.limited
+                elif expired:
+                    status = UserStatus.expired
+                else:
+                    if WEBHOOK_ADDRESS:
+                        add_notification_reminders(db, user, now)
+                    continue
+
+                xray.operations.remove_user(user)
+                update_user_status(db, user, status)
+
+                report.status_change(username=user.username, status=status,
+                                     user=UserResponse.model_validate(user), user_admin=user.admin)
+
+                logger.info(f"User \"{user.username}\" status changed to {status}")
+
+            if WEBHOOK_ADDRESS and user_ids is not None and last_review_ts is not None:
+                reviewed = set(user.id for user in active_users)
+                for user in get_reminder_candidates(db, last_review_ts, now_ts):
+                    if user.id not in reviewed:
+                        evaluated += 1
+                        add_notification_reminders(db, user, now)
+
+            for user in on_hold_users:
+
+                if user.edit_at:
+                    base_time = datetime.timestamp(user.edit_at)
+                else:
+                    base_time = datetime.timestamp(user.created_at)
+
+                # Check if the user is online After or at 'base_time'
+                online_at = users_last_seen.online_at(user.id, user.online_at)
+                if online_at and base_time <= datetime.timestamp(online_at):
+                    status = UserStatus.active
+
+                elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now_ts)):
+                    # If the user didn't connect within the timeout period, change status to "Active"
+                    status = UserStatus.active
+
+                else:
+                    continue
+
+                update_user_status(db, user, status)
+                start_user_expire(db, user)
+
+                report.status_change(username=user.username, status=status,
+                                     user=UserResponse.model_validate(user), user_admin=user.admin)
+
+                logger.info(f"User \"{user.username}\" status changed to {status}")
+
+    except Exception:
+        # keep the users for the next review
+        if user_ids is None:
+            users_to_review.add_all()
+        else:
+            users_to_review.add(*user_ids)
+        raise
+
+    last_review_ts = now_ts
+    logger.debug(f"{evaluated} users reviewed in {(time.time() - start_time):.3f} seconds")
 
 
 scheduler.add_job(review, 'interval',
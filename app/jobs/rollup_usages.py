@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from app import logger, scheduler
+from app.db import GetDB, crud
+from app.models.node import UsageGranularity
+from config import JOB_ROLLUP_USAGES_INTERVAL, USAGES_DAILY_RETENTION_DAYS, USAGES_HOURLY_RETENTION_DAYS
+
+
+def rollup_usages():
+    now = datetime.utcnow()
+    with GetDB() as db:
+        for granularity, retention, tier in ((UsageGranularity.day, USAGES_HOURLY_RETENTION_DAYS, "daily"),
+                                             (UsageGranularity.month, USAGES_DAILY_RETENTION_DAYS, "monthly")):
+            if retention < 0:
+                continue
+
+            compacted = crud.rollup_user_usages(db, granularity, now - timedelta(days=retention))
+            if compacted:
+                logger.info(f"{compacted} users' usage records rolled up into {tier} ones")
+
+
+if USAGES_HOURLY_RETENTION_DAYS >= 0 or USAGES_DAILY_RETENTION_DAYS >= 0:
+    scheduler.add_job(rollup_usages, 'interval',
+                      seconds=JOB_ROLLUP_USAGES_INTERVAL,
+                      coalesce=True, max_instances=1)
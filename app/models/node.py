@@ -1,5 +1,6 @@
+from datetime import datetime
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import ConfigDict, BaseModel, Field
 
@@ -11,6 +12,12 @@ class NodeStatus(str, Enum):
     disabled = "disabled"
 
 
+class UsageGranularity(str, Enum):
+    hour = "hour"
+    day = "day"
+    month = "month"
+
+
 class NodeSettings(BaseModel):
     min_node_version: str = "v0.2.0"
     certificate: str
@@ -70,7 +77,34 @@ class NodeUsageResponse(BaseModel):
     node_name: str
     uplink: int
     downlink: int
+    period_start: Optional[datetime] = None  # set when usages are grouped by a granularity
 
 
 class NodesUsageResponse(BaseModel):
     usages: List[NodeUsageResponse]
+
+
+class NodeOperationsResponse(BaseModel):
+    node_id: Optional[int] = None
+    node_name: str
+    queue_depth: int = 0
+    processed: int = 0
+    last_latency: float = 0.0
+    average_latency: float = 0.0
+
+
+class NodesOperationsResponse(BaseModel):
+    operations: List[NodeOperationsResponse]
+
+
+class NodeStatsCollectionResponse(BaseModel):
+    node_id: Optional[int] = None
+    node_name: str
+    stats: str
+    count: int = 0
+    late: int = 0
+    buckets: Dict[str, int] = {}
+
+
+class NodesStatsCollectionResponse(BaseModel):
+    collections: List[NodeStatsCollectionResponse]
@@ -4,7 +4,14 @@ from datetime import datetime
 from enum import Enum
 from typing import Dict, List, Optional, Union
 
-from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    ValidationInfo,
+    field_validator,
+    model_validator,
+)
 
 from app import xray
 from app.models.admin import Admin
@@ -40,6 +47,13 @@ class UserStatusCreate(str, Enum):
     on_hold = "on_hold"
 
 
+class UserResponseExtra(str, Enum):
+    """Fields of a user in a list that are only computed when requested."""
+    links = "links"
+    subscription_url = "subscription_url"
+    excluded_inbounds = "excluded_inbounds"
+
+
 class UserDataLimitResetStrategy(str, Enum):
     no_reset = "no_reset"
     day = "day"
@@ -336,15 +350,92 @@ class SubscriptionUserResponse(UserResponse):
     model_config = ConfigDict(from_attributes=True)
 
 
+class UserListResponse(UserResponse):
+    """
+    A user in a list, with only the extra fields given in the ``include``
+    of the validation context, the others are left as ``None``.
+    """
+    links: Optional[List[str]] = None
+    subscription_url: Optional[str] = None
+    excluded_inbounds: Optional[Dict[ProxyTypes, List[str]]] = None
+
+    @staticmethod
+    def _included(info: ValidationInfo) -> set:
+        return (info.context or {}).get("include", set())
+
+    @model_validator(mode="before")
+    @classmethod
+    def skip_extras(cls, data, info: ValidationInfo):
+        if isinstance(data, dict):
+            return data
+
+        # read the attributes of the db user here, so the extras which aren't included are never computed
+        included = cls._included(info)
+        values = {}
+        for name in cls.model_fields:
+            if name in UserResponseExtra.__members__ and name not in included:
+                continue
+            value = getattr(data, name, None)
+            if value is not None:
+                values[name] = value
+        return values
+
+    @model_validator(mode="after")
+    def validate_links(self, info: ValidationInfo):
+        if self.links is None and UserResponseExtra.links in self._included(info):
+            self.links = generate_v2ray_links(
+                self.proxies, self.inbounds, extra_data=self.model_dump(), reverse=False,
+            )
+        return self
+
+    @model_validator(mode="after")
+    def validate_subscription_url(self, info: ValidationInfo):
+        if self.subscription_url is None and UserResponseExtra.subscription_url in self._included(info):
+            salt = secrets.token_hex(8)
+            url_prefix = (XRAY_SUBSCRIPTION_URL_PREFIX).replace('*', salt)
+            token = create_subscription_token(self.username)
+            self.subscription_url = f"{url_prefix}/{XRAY_SUBSCRIPTION_PATH}/{token}"
+        return self
+
+
 class UsersResponse(BaseModel):
     users: List[UserResponse]
     total: int
 
 
+class UsersListResponse(BaseModel):
+    users: List[UserListResponse]
+    total: int
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+
+class UsersBulkModify(BaseModel):
+    data_limit: int = 0  # bytes added to the data limits, negative values subtract
+    expire: int = 0  # seconds added to the expiry dates, negative values subtract
+    status: Optional[List[UserStatus]] = None
+    admins: Optional[List[str]] = None
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "data_limit": 10737418240,
+            "expire": 2592000,
+            "status": ["active", "on_hold"],
+        }
+    })
+
+
+class UsersBulkModifyResponse(BaseModel):
+    modified: int
+    activated: List[str] = []
+    limited: List[str] = []
+    expired: List[str] = []
+
+
 class UserUsageResponse(BaseModel):
     node_id: Union[int, None] = None
     node_name: str
     used_traffic: int
+    period_start: Optional[datetime] = None  # set when usages are grouped by a granularity
 
     @field_validator("used_traffic",  mode='before')
     def cast_to_int(cls, v):
@@ -1,3 +1,4 @@
+import time
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Request, status
@@ -10,6 +11,7 @@ from app.dependencies import get_admin_by_username, validate_admin
 from app.models.admin import Admin, AdminCreate, AdminModify, Token
 from app.utils import report, responses
 from app.utils.jwt import create_admin_token
+from app.utils.usage import users_to_review
 from config import LOGIN_NOTIFY_WHITE_LIST
 
 router = APIRouter(tags=["Admin"], prefix="/api", responses={401: responses._401})
@@ -140,13 +142,16 @@ def disable_all_active_users(
     db: Session = Depends(get_db), admin: Admin = Depends(Admin.check_sudo_admin)
 ):
     """Disable all active users under a specific admin"""
-    crud.disable_all_active_users(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
-    return {"detail": "Users successfully disabled"}
+    start = time.perf_counter()
+    user_ids = crud.disable_all_active_users(db=db, admin=dbadmin)
+    elapsed = time.perf_counter() - start
+    sync = xray.operations.sync_users([], user_ids)
+    return {
+        "detail": "Users successfully disabled",
+        "users": len(user_ids),
+        "method": sync["method"],
+        "timings": {"database": round(elapsed, 3), "cores": sync["elapsed"]},
+    }
 
 
 @router.post("/admin/{username}/users/activate", responses={403: responses._403, 404: responses._404})
@@ -155,13 +160,17 @@ def activate_all_disabled_users(
     db: Session = Depends(get_db), admin: Admin = Depends(Admin.check_sudo_admin)
 ):
     """Activate all disabled users under a specific admin"""
-    crud.activate_all_disabled_users(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
-    return {"detail": "Users successfully activated"}
+    start = time.perf_counter()
+    user_ids = crud.activate_all_disabled_users(db=db, admin=dbadmin)
+    elapsed = time.perf_counter() - start
+    users_to_review.add(*user_ids)
+    sync = xray.operations.sync_users(user_ids, [])
+    return {
+        "detail": "Users successfully activated",
+        "users": len(user_ids),
+        "method": sync["method"],
+        "timings": {"database": round(elapsed, 3), "cores": sync["elapsed"]},
+    }
 
 
 @router.post(
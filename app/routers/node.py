@@ -1,6 +1,6 @@
 import asyncio
 import time
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, WebSocket
 from sqlalchemy.exc import IntegrityError
@@ -16,10 +16,14 @@ from app.models.node import (
     NodeResponse,
     NodeSettings,
     NodeStatus,
+    NodesOperationsResponse,
+    NodesStatsCollectionResponse,
     NodesUsageResponse,
+    UsageGranularity,
 )
 from app.models.proxy import ProxyHost
 from app.utils import responses
+from app.xray.collector import collectors
 
 router = APIRouter(
     tags=["Node"], prefix="/api", responses={401: responses._401, 403: responses._403}
@@ -155,6 +159,37 @@ def get_nodes(
     return crud.get_nodes(db)
 
 
+@router.get("/nodes/operations", response_model=NodesOperationsResponse)
+def get_operations(
+    db: Session = Depends(get_db), _: Admin = Depends(Admin.check_sudo_admin)
+):
+    """Retrieve the pending user operations and their latency (in seconds) for the main core and each node."""
+    stats = xray.operations.get_queues_stats()
+
+    operations = [{"node_id": None, "node_name": "Master", **stats.get(None, {})}]
+    for dbnode in crud.get_nodes(db):
+        operations.append({"node_id": dbnode.id, "node_name": dbnode.name, **stats.get(dbnode.id, {})})
+
+    return {"operations": operations}
+
+
+@router.get("/nodes/stats-collection", response_model=NodesStatsCollectionResponse)
+def get_stats_collection(
+    db: Session = Depends(get_db), _: Admin = Depends(Admin.check_sudo_admin)
+):
+    """Retrieve the latency histogram (in seconds) of fetching stats from the main core and each node."""
+    node_names = {None: "Master"}
+    node_names.update({dbnode.id: dbnode.name for dbnode in crud.get_nodes(db)})
+
+    collections = []
+    for name, collector in collectors.items():
+        for node_id, stats in collector.get_stats().items():
+            if node_id in node_names:
+                collections.append({"node_id": node_id, "node_name": node_names[node_id], "stats": name, **stats})
+
+    return {"collections": collections}
+
+
 @router.put("/node/{node_id}", response_model=NodeResponse)
 def modify_node(
     modified_node: NodeModify,
@@ -203,11 +238,12 @@ def get_usage(
     db: Session = Depends(get_db),
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     _: Admin = Depends(Admin.check_sudo_admin),
 ):
     """Retrieve usage statistics for nodes within a specified date range."""
     start, end = validate_dates(start, end)
 
-    usages = crud.get_nodes_usage(db, start, end)
+    usages = crud.get_nodes_usage(db, start, end, granularity)
 
     return {"usages": usages}
@@ -1,13 +1,18 @@
 import re
 from distutils.version import LooseVersion
+from typing import Optional
 
 from fastapi import APIRouter, Depends, Header, Path, Request, Response
 from fastapi.responses import HTMLResponse
 
 from app.db import Session, crud, get_db
 from app.dependencies import get_validated_sub, validate_dates
+from app.models.node import UsageGranularity
 from app.models.user import SubscriptionUserResponse, UserResponse
+from app.subscription import compression
+from app.subscription.cache import subscriptions_cache
 from app.subscription.share import encode_title, generate_subscription
+from app.subscription.updates import sub_updates
 from app.templates import render_template
 from config import (
     SUB_PROFILE_TITLE,
@@ -45,6 +50,51 @@ def get_subscription_user_info(user: UserResponse) -> dict:
     }
 
 
+def subscription_response(
+    request: Request,
+    dbuser: UserResponse,
+    config_format: str,
+    as_base64: bool,
+    reverse: bool,
+    media_type: str,
+    headers: dict,
+) -> Response:
+    """
+    Returns the cached subscription if possible, or 304 if the client already has it.
+    It's compressed with the best encoding the client accepts, once while it's cached.
+    """
+    headers = {**headers, "Vary": "Accept-Encoding"}
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+
+    if not subscriptions_cache.enabled:
+        conf = generate_subscription(user=UserResponse.model_validate(dbuser), config_format=config_format,
+                                     as_base64=as_base64, reverse=reverse)
+        body = conf.encode()
+        encoding = compression.negotiate(accept_encoding, len(body))
+        if encoding:
+            return Response(content=compression.compress(body, encoding), media_type=media_type,
+                            headers={**headers, "Content-Encoding": encoding})
+        return Response(content=body, media_type=media_type, headers=headers)
+
+    etag = subscriptions_cache.etag(dbuser, config_format, as_base64, reverse)
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag and etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+
+    etag, conf = subscriptions_cache.get_or_render(
+        dbuser, config_format, as_base64, reverse,
+        render=lambda: generate_subscription(user=UserResponse.model_validate(dbuser), config_format=config_format,
+                                             as_base64=as_base64, reverse=reverse),
+    )
+    body = conf.encode()
+    encoding = compression.negotiate(accept_encoding, len(body))
+    if encoding:
+        content = subscriptions_cache.get_compressed(dbuser, config_format, as_base64, reverse, etag, body, encoding)
+        return Response(content=content, media_type=media_type,
+                        headers={**headers, "ETag": etag, "Content-Encoding": encoding})
+    return Response(content=body, media_type=media_type, headers={**headers, "ETag": etag})
+
+
 @router.get("/{token}/")
 @router.get("/{token}", include_in_schema=False)
 def user_subscription(
@@ -54,89 +104,85 @@ def user_subscription(
     user_agent: str = Header(default="")
 ):
     """Provides a subscription link based on the user agent (Clash, V2Ray, etc.)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
     accept_header = request.headers.get("Accept", "")
     if "text/html" in accept_header:
         return HTMLResponse(
             render_template(
                 SUBSCRIPTION_PAGE_TEMPLATE,
-                {"user": user}
+                {"user": UserResponse.model_validate(dbuser)}
             )
         )
 
-    crud.update_user_sub(db, dbuser, user_agent)
+    sub_updates.add(dbuser.id, user_agent)
     response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
+        "content-disposition": f'attachment; filename="{dbuser.username}"',
         "profile-web-page-url": str(request.url),
         "support-url": SUB_SUPPORT_URL,
         "profile-title": encode_title(SUB_PROFILE_TITLE),
         "profile-update-interval": SUB_UPDATE_INTERVAL,
         "subscription-userinfo": "; ".join(
             f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
+            for key, val in get_subscription_user_info(dbuser).items()
         )
     }
 
     if re.match(r'^([Cc]lash-verge|[Cc]lash[-\.]?[Mm]eta|[Ff][Ll][Cc]lash|[Mm]ihomo)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash-meta", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        return subscription_response(request, dbuser, "clash-meta", as_base64=False, reverse=False,
+                                     media_type="text/yaml", headers=response_headers)
 
     elif re.match(r'^([Cc]lash|[Ss]tash)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        return subscription_response(request, dbuser, "clash", as_base64=False, reverse=False,
+                                     media_type="text/yaml", headers=response_headers)
 
     elif re.match(r'^(SFA|SFI|SFM|SFT|[Kk]aring|[Hh]iddify[Nn]ext)', user_agent):
-        conf = generate_subscription(user=user, config_format="sing-box", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        return subscription_response(request, dbuser, "sing-box", as_base64=False, reverse=False,
+                                     media_type="application/json", headers=response_headers)
 
     elif re.match(r'^(SS|SSR|SSD|SSS|Outline|Shadowsocks|SSconf)', user_agent):
-        conf = generate_subscription(user=user, config_format="outline", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        return subscription_response(request, dbuser, "outline", as_base64=False, reverse=False,
+                                     media_type="application/json", headers=response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYN) and re.match(r'^v2rayN/(\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayN/(\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("6.40"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray-json", as_base64=False, reverse=False,
+                                         media_type="application/json", headers=response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray", as_base64=True, reverse=False,
+                                         media_type="text/plain", headers=response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYNG) and re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.8.29"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray-json", as_base64=False, reverse=False,
+                                         media_type="application/json", headers=response_headers)
         elif LooseVersion(version_str) >= LooseVersion("1.8.18"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=True)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray-json", as_base64=False, reverse=True,
+                                         media_type="application/json", headers=response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray", as_base64=True, reverse=False,
+                                         media_type="text/plain", headers=response_headers)
 
     elif re.match(r'^[Ss]treisand', user_agent):
         if USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_STREISAND:
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray-json", as_base64=False, reverse=False,
+                                         media_type="application/json", headers=response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray", as_base64=True, reverse=False,
+                                         media_type="text/plain", headers=response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_HAPP) and re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.63.1"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return subscription_response(request, dbuser, "v2ray-json", as_base64=False, reverse=False,
+                                         media_type="application/json", headers=response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
-
-
+            return subscription_response(request, dbuser, "v2ray", as_base64=True, reverse=False,
+                                         media_type="text/plain", headers=response_headers)
 
     else:
-        conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-        return Response(content=conf, media_type="text/plain", headers=response_headers)
+        return subscription_response(request, dbuser, "v2ray", as_base64=True, reverse=False,
+                                     media_type="text/plain", headers=response_headers)
 
 
 @router.get("/{token}/info", response_model=SubscriptionUserResponse)
@@ -152,12 +198,13 @@ def user_get_usage(
     dbuser: UserResponse = Depends(get_validated_sub),
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db)
 ):
     """Fetches the usage statistics for the user within a specified date range."""
     start, end = validate_dates(start, end)
 
-    usages = crud.get_user_usages(db, dbuser, start, end)
+    usages = crud.get_user_usages(db, dbuser, start, end, granularity)
 
     return {"usages": usages, "username": dbuser.username}
 
@@ -171,24 +218,22 @@ def user_subscription_with_client_type(
     user_agent: str = Header(default="")
 ):
     """Provides a subscription link based on the specified client type (e.g., Clash, V2Ray)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
     response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
+        "content-disposition": f'attachment; filename="{dbuser.username}"',
         "profile-web-page-url": str(request.url),
         "support-url": SUB_SUPPORT_URL,
         "profile-title": encode_title(SUB_PROFILE_TITLE),
         "profile-update-interval": SUB_UPDATE_INTERVAL,
         "subscription-userinfo": "; ".join(
             f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
+            for key, val in get_subscription_user_info(dbuser).items()
         )
     }
 
     config = client_config.get(client_type)
-    conf = generate_subscription(user=user,
+    return subscription_response(request, dbuser,
                                  config_format=config["config_format"],
                                  as_base64=config["as_base64"],
-                                 reverse=config["reverse"])
-
-    return Response(content=conf, media_type=config["media_type"], headers=response_headers)
+                                 reverse=config["reverse"],
+                                 media_type=config["media_type"],
+                                 headers=response_headers)
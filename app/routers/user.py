@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Union
 
@@ -8,15 +9,22 @@ from app import logger, xray
 from app.db import Session, crud, get_db
 from app.dependencies import get_expired_users_list, get_validated_user, validate_dates
 from app.models.admin import Admin
+from app.models.node import UsageGranularity
 from app.models.user import (
     UserCreate,
+    UserListResponse,
     UserModify,
     UserResponse,
+    UserResponseExtra,
+    UsersBulkModify,
+    UsersBulkModifyResponse,
+    UsersListResponse,
     UsersResponse,
     UserStatus,
     UsersUsagesResponse,
     UserUsagesResponse,
 )
+from app.subscription.cache import subscriptions_cache
 from app.utils import report, responses
 
 router = APIRouter(tags=["User"], prefix="/api", responses={401: responses._401})
@@ -110,6 +118,7 @@ def modify_user(
 
     old_status = dbuser.status
     dbuser = crud.update_user(db, dbuser, modified_user)
+    subscriptions_cache.invalidate(dbuser.id)
     user = UserResponse.model_validate(dbuser)
 
     if user.status in [UserStatus.active, UserStatus.on_hold]:
@@ -145,6 +154,7 @@ def remove_user(
     admin: Admin = Depends(Admin.get_current),
 ):
     """Remove a user"""
+    subscriptions_cache.invalidate(dbuser.id)
     crud.remove_user(db, dbuser)
     bg.add_task(xray.operations.remove_user, dbuser=dbuser)
 
@@ -186,6 +196,7 @@ def revoke_user_subscription(
 ):
     """Revoke users subscription (Subscription link and proxies)"""
     dbuser = crud.revoke_user_sub(db=db, dbuser=dbuser)
+    subscriptions_cache.invalidate(dbuser.id)
 
     if dbuser.status in [UserStatus.active, UserStatus.on_hold]:
         bg.add_task(xray.operations.update_user, dbuser=dbuser)
@@ -199,7 +210,7 @@ def revoke_user_subscription(
     return user
 
 
-@router.get("/users", response_model=UsersResponse, responses={400: responses._400, 403: responses._403, 404: responses._404})
+@router.get("/users", response_model=UsersListResponse, responses={400: responses._400, 403: responses._403, 404: responses._404})
 def get_users(
     offset: int = None,
     limit: int = None,
@@ -208,10 +219,34 @@ def get_users(
     owner: Union[List[str], None] = Query(None, alias="admin"),
     status: UserStatus = None,
     sort: str = None,
+    include: Optional[str] = Query(
+        None,
+        description="Comma separated extra fields to compute for each user "
+                    "(links, subscription_url, excluded_inbounds), all of them if it's not given",
+    ),
+    cursor: Optional[str] = Query(
+        None, description="next_cursor or prev_cursor of a previous page, to get the page after or before it"
+    ),
+    approximate_total: bool = Query(
+        False, description="Whether the total can be counted up to a minute ago, which is cheaper"
+    ),
     db: Session = Depends(get_db),
     admin: Admin = Depends(Admin.get_current),
 ):
     """Get all users"""
+    if include is None:
+        include = set(UserResponseExtra)
+    else:
+        opts = include.strip(",").split(",") if include.strip(",") else []
+        include = set()
+        for opt in opts:
+            try:
+                include.add(UserResponseExtra[opt])
+            except KeyError:
+                raise HTTPException(
+                    status_code=400, detail=f'"{opt}" is not a valid include option'
+                )
+
     if sort is not None:
         opts = sort.strip(",").split(",")
         sort = []
@@ -223,6 +258,13 @@ def get_users(
                     status_code=400, detail=f'"{opt}" is not a valid sort option'
                 )
 
+    backward = False
+    if cursor:
+        try:
+            _, _, backward = crud.decode_users_cursor(cursor, sort)
+        except ValueError as err:
+            raise HTTPException(status_code=400, detail=str(err))
+
     users, count = crud.get_users(
         db=db,
         offset=offset,
@@ -233,9 +275,24 @@ def get_users(
         sort=sort,
         admins=owner if admin.is_sudo else [admin.username],
         return_with_count=True,
+        with_relations=True,
+        cursor=cursor,
+        approximate_count=approximate_total,
     )
 
-    return {"users": users, "total": count}
+    next_cursor = prev_cursor = None
+    if users:
+        if limit and (backward or len(users) == limit):
+            next_cursor = crud.encode_users_cursor(users[-1], sort)
+        if (limit and backward and len(users) == limit) or (not backward and (cursor or offset)):
+            prev_cursor = crud.encode_users_cursor(users[0], sort, backward=True)
+
+    return {
+        "users": [UserListResponse.model_validate(user, context={"include": include}) for user in users],
+        "total": count,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
 
 
 @router.post("/users/reset", responses={403: responses._403, 404: responses._404})
@@ -244,13 +301,50 @@ def reset_users_data_usage(
 ):
     """Reset all users data usage"""
     dbadmin = crud.get_admin(db, admin.username)
-    crud.reset_all_users_data_usage(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
-    return {"detail": "Users successfully reset."}
+    start = time.perf_counter()
+    user_ids = crud.reset_all_users_data_usage(db=db, admin=dbadmin)
+    elapsed = time.perf_counter() - start
+    sync = xray.operations.sync_users(user_ids, [])
+    return {
+        "detail": "Users successfully reset.",
+        "users": len(user_ids),
+        "method": sync["method"],
+        "timings": {"database": round(elapsed, 3), "cores": sync["elapsed"]},
+    }
+
+
+@router.post("/users/bulk", response_model=UsersBulkModifyResponse, responses={403: responses._403})
+def bulk_modify_users(
+    modify: UsersBulkModify,
+    bg: BackgroundTasks,
+    db: Session = Depends(get_db),
+    admin: Admin = Depends(Admin.get_current),
+):
+    """
+    Add to the data limits and expiry dates of users
+
+    - **data_limit**: Bytes added to the data limits of the users that have one, negative values subtract.
+    - **expire**: Seconds added to the expiry dates of the users that have one, negative values subtract.
+    - **status**: Only modify the users with these statuses, defaults to all of them.
+    - **admins**: Only modify the users of these admins, non-sudo admins only modify their own users.
+
+    The statuses of the modified users are updated, and only the users whose status changed are
+    added to or removed from the cores.
+    """
+    admins = modify.admins if admin.is_sudo else [admin.username]
+    user_ids, changes = crud.bulk_modify_users(db, modify.data_limit, modify.expire, modify.status, admins)
+
+    response = UsersBulkModifyResponse(modified=len(user_ids))
+    for status, changed_ids in changes.items():
+        for dbuser in crud.iter_users(db, changed_ids):
+            getattr(response, status.value).append(dbuser.username)
+
+    removed_ids = [user_id for status, changed_ids in changes.items() if status != UserStatus.active
+                   for user_id in changed_ids]
+    bg.add_task(xray.operations.sync_users, changes.get(UserStatus.active, []), removed_ids)
+
+    logger.info(f'{len(user_ids)} users modified in bulk by admin "{admin.username}"')
+    return response
 
 
 @router.get("/user/{username}/usage", response_model=UserUsagesResponse, responses={403: responses._403, 404: responses._404})
@@ -258,12 +352,13 @@ def get_user_usage(
     dbuser: UserResponse = Depends(get_validated_user),
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db),
 ):
     """Get users usage"""
     start, end = validate_dates(start, end)
 
-    usages = crud.get_user_usages(db, dbuser, start, end)
+    usages = crud.get_user_usages(db, dbuser, start, end, granularity)
 
     return {"usages": usages, "username": dbuser.username}
 
@@ -299,6 +394,7 @@ def active_next_plan(
 def get_users_usage(
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db),
     owner: Union[List[str], None] = Query(None, alias="admin"),
     admin: Admin = Depends(Admin.get_current),
@@ -307,7 +403,7 @@ def get_users_usage(
     start, end = validate_dates(start, end)
 
     usages = crud.get_all_users_usages(
-        db=db, start=start, end=end, admin=owner if admin.is_sudo else [admin.username]
+        db=db, start=start, end=end, admin=owner if admin.is_sudo else [admin.username], granularity=granularity
     )
 
     return {"usages": usages}
@@ -0,0 +1,130 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple
+
+from app import xray
+from app.subscription.compression import compress
+from config import SUB_CACHE_SIZE, SUB_CACHE_TTL
+
+if TYPE_CHECKING:
+    from app.db.models import User
+
+
+class CacheEntry:
+    __slots__ = ("revision", "expires_at", "etag", "content", "compressed")
+
+    def __init__(self, revision: str, expires_at: float, etag: str, content: str):
+        self.revision = revision
+        self.expires_at = expires_at
+        self.etag = etag
+        self.content = content
+        self.compressed: Dict[str, bytes] = {}
+
+
+class SubscriptionCache:
+    """
+    LRU cache of rendered subscriptions.
+
+    An entry is kept per user, format and ordering and is reused while the
+    user's revision, the hosts and the xray config are unchanged, for at most
+    ``ttl`` seconds after it's rendered so the time dependent variables (e.g.
+    ``{TIME_LEFT}``) and the per-host randomization are refreshed now and then.
+    The compressed variants of a subscription are kept along with it.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.maxsize > 0
+
+    @staticmethod
+    def user_revision(dbuser: "User") -> tuple:
+        """Returns the values of the user that its subscription is rendered from."""
+        return (
+            dbuser.username,
+            dbuser.status,
+            dbuser.used_traffic,
+            dbuser.data_limit,
+            dbuser.expire,
+            dbuser.on_hold_expire_duration,
+            dbuser.edit_at,  # set when proxies or inbounds are modified
+            dbuser.sub_revoked_at,
+        )
+
+    def revision(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool) -> str:
+        """Returns the revision of the subscription, it changes whenever the subscription must be rendered again."""
+        key = (dbuser.id, self.user_revision(dbuser), config_format, as_base64, reverse,
+               xray.hosts.version, id(xray.config))
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    def _get(self, key: tuple, revision: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry and entry.revision == revision and entry.expires_at > time.monotonic():
+            return entry
+
+    def etag(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool) -> Optional[str]:
+        """Returns the ETag of the cached subscription, or ``None`` if it must be rendered again."""
+        key = (dbuser.id, config_format, as_base64, reverse)
+        revision = self.revision(dbuser, config_format, as_base64, reverse)
+        with self._lock:
+            entry = self._get(key, revision)
+            return entry.etag if entry else None
+
+    def get_or_render(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool,
+                      render: Callable[[], str]) -> Tuple[str, str]:
+        """Returns the ``(etag, content)`` of the subscription, calling ``render`` only if it's not cached."""
+        key = (dbuser.id, config_format, as_base64, reverse)
+        revision = self.revision(dbuser, config_format, as_base64, reverse)
+        with self._lock:
+            entry = self._get(key, revision)
+            if entry:
+                self._entries.move_to_end(key)
+                return entry.etag, entry.content
+
+        content = render()
+        # each rendering gets its own ETag, the time dependent variables may differ between them
+        etag = f'W/"{hashlib.blake2b(f"{revision}:{time.time_ns()}".encode(), digest_size=16).hexdigest()}"'
+        with self._lock:
+            self._entries[key] = CacheEntry(revision, time.monotonic() + self.ttl, etag, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return etag, content
+
+    def get_compressed(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool,
+                       etag: str, content: bytes, encoding: str) -> bytes:
+        """Returns the subscription compressed with ``encoding``, compressing it only once while it's cached."""
+        key = (dbuser.id, config_format, as_base64, reverse)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.etag == etag and encoding in entry.compressed:
+                return entry.compressed[encoding]
+
+        compressed = compress(content, encoding)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.etag == etag:
+                entry.compressed[encoding] = compressed
+
+        return compressed
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Forgets the subscriptions of a user, or of every user if ``user_id`` is ``None``."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                return
+
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+
+subscriptions_cache = SubscriptionCache(SUB_CACHE_SIZE, SUB_CACHE_TTL)
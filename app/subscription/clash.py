@@ -1,13 +1,14 @@
 import copy
-import json
 from random import choice
 from uuid import UUID
 
+import jinja2
 import yaml
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app import logger
+from app.subscription.funcs import copy_nested, get_grpc_gun
+from app.templates import build_template, load_template, render_template
 from app.utils.helpers import yml_uuid_representer
 from config import (
     CLASH_SETTINGS_TEMPLATE,
@@ -16,6 +17,85 @@ from config import (
     USER_AGENT_TEMPLATE,
 )
 
+# the "yaml" filter of the templates dumps with the default dumper
+yaml.add_representer(UUID, yml_uuid_representer)
+
+
+class ClashDumper(getattr(yaml, "CSafeDumper", yaml.SafeDumper)):
+    """Dumps with libyaml when PyYAML was built with it."""
+
+
+ClashDumper.add_representer(UUID, yml_uuid_representer)
+
+# stand in for the proxies and their remarks when the subscription template is rendered into a skeleton
+PROXIES_MARK = "\0proxies"
+REMARKS_MARK = "\0proxy_remarks"
+SKELETON_CONTEXT = {
+    "conf": {"proxies": [PROXIES_MARK], "proxy-groups": [], "rules": []},
+    "proxy_remarks": [REMARKS_MARK],
+}
+# the skeleton is checked against a round trip through the template with these proxies
+SAMPLE_PROXIES = [
+    {"name": "sample 1", "type": "vless", "server": "example.com", "port": 443, "network": "tcp", "udp": True},
+    {"name": "sample 2", "type": "trojan", "server": "example.com", "port": 443, "network": "ws", "udp": True,
+     "ws-opts": {"path": "/", "headers": {"Host": "example.com"}}},
+]
+
+
+def sort_keys(data):
+    """Returns a copy of the data with its mappings sorted by keys, as the "yaml" filter dumps them."""
+    if isinstance(data, dict):
+        return {key: sort_keys(data[key]) for key in sorted(data)}
+    if isinstance(data, list):
+        return [sort_keys(item) for item in data]
+    return data
+
+
+def fill_skeleton(skeleton, values: dict):
+    """Returns a copy of the skeleton, where each list of a single mark is replaced by its sorted value."""
+    if isinstance(skeleton, dict):
+        return {key: fill_skeleton(value, values) for key, value in skeleton.items()}
+    if isinstance(skeleton, list):
+        if len(skeleton) == 1 and isinstance(skeleton[0], str) and skeleton[0] in values:
+            return sort_keys(values[skeleton[0]])
+        return [fill_skeleton(item, values) for item in skeleton]
+    return skeleton
+
+
+def build_skeleton(template: jinja2.Template):
+    """
+    Returns the subscription template rendered with the marks and parsed, or None if
+    filling it differs from rendering the template with proxies, e.g. when it loops over them.
+    """
+    remarks = [proxy["name"] for proxy in SAMPLE_PROXIES]
+    try:
+        skeleton = yaml.load(template.render(SKELETON_CONTEXT), Loader=yaml.SafeLoader)
+        sample = yaml.load(
+            template.render({"conf": {"proxies": SAMPLE_PROXIES, "proxy-groups": [], "rules": []},
+                             "proxy_remarks": remarks}),
+            Loader=yaml.SafeLoader
+        )
+    except Exception:
+        skeleton = sample = None
+
+    if skeleton is None or fill_skeleton(skeleton, {PROXIES_MARK: SAMPLE_PROXIES, REMARKS_MARK: remarks}) != sample:
+        logger.info(f"Clash subscription template {template.name} is rendered for each subscription")
+        return None
+    return skeleton
+
+
+def dump(data) -> str:
+    # unlike PyYAML, libyaml escapes the characters out of the BMP (e.g. flag emojis), folds
+    # double-quoted scalars differently and can't encode lone surrogates, the configs it emits
+    # without a backslash are the same as PyYAML's
+    try:
+        config = yaml.dump(data, Dumper=ClashDumper, sort_keys=False, allow_unicode=True)
+        if "\\" not in config:
+            return config
+    except UnicodeEncodeError:
+        pass
+    return yaml.dump(data, sort_keys=False, allow_unicode=True)
+
 
 class ClashConfiguration(object):
     def __init__(self):
@@ -26,8 +106,8 @@ class ClashConfiguration(object):
             'rules': []
         }
         self.proxy_remarks = []
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.mux_template = load_template(MUX_TEMPLATE)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
@@ -35,7 +115,7 @@ class ClashConfiguration(object):
             self.user_agent_list = []
 
         try:
-            self.settings = yaml.load(render_template(CLASH_SETTINGS_TEMPLATE), Loader=yaml.SafeLoader)
+            self.settings = load_template(CLASH_SETTINGS_TEMPLATE, yaml.safe_load)
         except TemplateNotFound:
             self.settings = {}
 
@@ -45,19 +125,23 @@ class ClashConfiguration(object):
         if reverse:
             self.data['proxies'].reverse()
 
-        yaml.add_representer(UUID, yml_uuid_representer)
-        return yaml.dump(
-            yaml.load(
+        # the proxies are put in the template's skeleton as they are, instead of being dumped
+        # into the rendered template and parsed back from it. the "yaml" filter renders
+        # nothing for empty lists, so the configs without proxies are always rendered
+        skeleton = build_template(CLASH_SUBSCRIPTION_TEMPLATE, build_skeleton)
+        if skeleton is not None and self.data['proxies']:
+            data = fill_skeleton(skeleton, {PROXIES_MARK: self.data['proxies'], REMARKS_MARK: self.proxy_remarks})
+        else:
+            # the proxies share fragments of the settings, which the "yaml" filter would dump as aliases
+            data = yaml.load(
                 render_template(
                     CLASH_SUBSCRIPTION_TEMPLATE,
-                    {"conf": self.data, "proxy_remarks": self.proxy_remarks}
+                    {"conf": copy.deepcopy(self.data), "proxy_remarks": self.proxy_remarks}
                 ),
                 Loader=yaml.SafeLoader
+            )
 
-            ),
-            sort_keys=False,
-            allow_unicode=True,
-        )
+        return dump(data)
 
     def __str__(self) -> str:
         return self.render()
@@ -81,7 +165,7 @@ class ClashConfiguration(object):
             host="",
             random_user_agent: bool = False,
     ):
-        config = copy.deepcopy(self.settings.get("http-opts", {
+        config = dict(self.settings.get("http-opts", {
             'headers': {}
         }))
 
@@ -90,9 +174,7 @@ class ClashConfiguration(object):
         if host:
             config["Host"] = host
         if random_user_agent:
-            if "headers" not in config:
-                config["headers"] = {}
-            config["header"]["User-Agent"] = choice(self.user_agent_list)
+            copy_nested(config, "headers")["User-Agent"] = choice(self.user_agent_list)
 
         return config
 
@@ -105,15 +187,15 @@ class ClashConfiguration(object):
             is_httpupgrade: bool = False,
             random_user_agent: bool = False,
     ):
-        config = copy.deepcopy(self.settings.get("ws-opts", {}))
-        if (host or random_user_agent) and "headers" not in config:
-            config["headers"] = {}
+        config = dict(self.settings.get("ws-opts", {}))
+        if host or random_user_agent:
+            headers = copy_nested(config, "headers")
         if path:
             config["path"] = path
         if host:
-            config["headers"]["Host"] = host
+            headers["Host"] = host
         if random_user_agent:
-            config["headers"]["User-Agent"] = choice(self.user_agent_list)
+            headers["User-Agent"] = choice(self.user_agent_list)
         if max_early_data and not is_httpupgrade:
             config["max-early-data"] = max_early_data
             config["early-data-header-name"] = early_data_header_name
@@ -124,14 +206,14 @@ class ClashConfiguration(object):
         return config
 
     def grpc_config(self, path=""):
-        config = copy.deepcopy(self.settings.get("grpc-opts", {}))
+        config = dict(self.settings.get("grpc-opts", {}))
         if path:
             config["grpc-service-name"] = path
 
         return config
 
     def h2_config(self, path="", host=""):
-        config = copy.deepcopy(self.settings.get("h2-opts", {}))
+        config = dict(self.settings.get("h2-opts", {}))
         if path:
             config["path"] = path
         if host:
@@ -140,13 +222,11 @@ class ClashConfiguration(object):
         return config
 
     def tcp_config(self, path="", host=""):
-        config = copy.deepcopy(self.settings.get("tcp-opts", {}))
+        config = dict(self.settings.get("tcp-opts", {}))
         if path:
             config["path"] = [path]
         if host:
-            if "headers" not in config:
-                config["headers"] = {}
-            config["headers"]["Host"] = host
+            copy_nested(config, "headers")["Host"] = host
 
         return config
 
@@ -245,8 +325,8 @@ class ClashConfiguration(object):
 
         node[f'{network}-opts'] = net_opts
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["clash"]
+        # the cached template is shared, so each proxy gets its own copy
+        mux_config = dict(self.mux_template["clash"])
 
         if mux_enable:
             node['smux'] = mux_config
@@ -0,0 +1,45 @@
+import gzip
+from typing import Optional
+
+from config import SUB_COMPRESSION_MIN_SIZE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# the encodings in the order they're preferred, when the client accepts several of them equally
+ENCODINGS = {}
+if brotli is not None:
+    ENCODINGS["br"] = lambda content: brotli.compress(content, quality=BROTLI_QUALITY)
+ENCODINGS["gzip"] = lambda content: gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def negotiate(accept_encoding: str, size: int) -> Optional[str]:
+    """Returns the encoding to compress a subscription of ``size`` bytes with, or None to send it as it is."""
+    if SUB_COMPRESSION_MIN_SIZE < 0 or size < SUB_COMPRESSION_MIN_SIZE or not accept_encoding:
+        return None
+
+    accepted = {}
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    default = accepted.get("*", 0.0)
+    encoding = max(ENCODINGS, key=lambda name: accepted.get(name, default))
+    return encoding if accepted.get(encoding, default) > 0 else None
+
+
+def compress(content: bytes, encoding: str) -> bytes:
+    return ENCODINGS[encoding](content)
@@ -17,4 +17,17 @@ def get_grpc_multi(path: str) -> str:
     servicename = path.rsplit("/", 1)[0]
     streamname = path.rsplit("/", 1)[1].split("|")[1]
 
-    return "%s%s%s" % (servicename, "/", streamname)
\ No newline at end of file
+    return "%s%s%s" % (servicename, "/", streamname)
+
+def copy_nested(config: dict, *keys: str) -> dict:
+    """
+    Copies the dicts nested in ``config`` along ``keys``, creating the missing ones, and returns the innermost.
+
+    The transport settings are shallow copies of the cached settings templates,
+    so the nested dicts they share with them are copied before being modified.
+    """
+    for key in keys:
+        nested = dict(config.get(key, {}))
+        config[key] = nested
+        config = nested
+    return config
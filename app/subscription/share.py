@@ -229,6 +229,73 @@ def setup_format_variables(extra_data: dict) -> dict:
     return format_variables
 
 
+def needs_format(value: str) -> bool:
+    """Returns whether a host's field uses variables, the others are used as they are."""
+    return "{" in value or "}" in value
+
+
+def pick(values: list) -> str:
+    """Returns a random value of a host's field, or an empty string if it has none."""
+    if len(values) > 1:
+        return random.choice(values)
+    return values[0] if values else ""
+
+
+def build_hosts_plan() -> dict:
+    """
+    Prepares the hosts of each inbound for rendering the subscriptions: their order and
+    what doesn't depend on the user is resolved once, the random values and the fields
+    that use variables are left to each subscription.
+    """
+    plan = {}
+    for tag, inbound in xray.config.inbounds_by_tag.items():
+        plan[tag] = []
+        for host in xray.hosts.get(tag, []):
+            path = host["path"] if host["path"] is not None else inbound.get("path", "")
+            plan[tag].append({
+                "remark": host["remark"],
+                "remark_format": needs_format(host["remark"]),
+                "address": host["address"],
+                "address_format": any(needs_format(address) for address in host["address"]),
+                "path": path,
+                "path_format": needs_format(path),
+                "sni": host["sni"] or inbound["sni"],
+                "host": host["host"] or inbound["host"],
+                "use_sni_as_host": host.get("use_sni_as_host", False),
+                "sids": inbound.get("sids"),
+                "inbound": {
+                    **inbound,
+                    "port": host["port"] or inbound["port"],
+                    "tls": inbound["tls"] if host["tls"] is None else host["tls"],
+                    "alpn": host["alpn"] if host["alpn"] else None,
+                    "fp": host["fingerprint"] or inbound.get("fp", ""),
+                    "ais": host["allowinsecure"] or inbound.get("allowinsecure", ""),
+                    "mux_enable": host["mux_enable"],
+                    "fragment_setting": host["fragment_setting"],
+                    "noise_setting": host["noise_setting"],
+                    "random_user_agent": host["random_user_agent"],
+                },
+            })
+
+    return plan
+
+
+_hosts_plan = (None, {}, {})
+
+
+def get_hosts_plan() -> tuple:
+    """Returns the order of the inbounds and their hosts plan, rebuilt when the hosts or the xray config change."""
+    global _hosts_plan
+
+    xray.hosts.keys()  # loads the hosts, so their version is the one the plan is built from
+    key = (xray.hosts.version, id(xray.config))
+    if _hosts_plan[0] != key:
+        index = {tag: i for i, tag in enumerate(xray.config.inbounds_by_tag)}
+        _hosts_plan = (key, index, build_hosts_plan())
+
+    return _hosts_plan[1], _hosts_plan[2]
+
+
 def process_inbounds_and_tags(
         inbounds: dict,
         proxies: dict,
@@ -243,82 +310,58 @@ def process_inbounds_and_tags(
         ],
         reverse=False,
 ) -> Union[List, str]:
-    _inbounds = []
-    for protocol, tags in inbounds.items():
-        for tag in tags:
-            _inbounds.append((protocol, [tag]))
-    index_dict = {proxy: index for index, proxy in enumerate(
-        xray.config.inbounds_by_tag.keys())}
+    index, plan = get_hosts_plan()
     inbounds = sorted(
-        _inbounds, key=lambda x: index_dict.get(x[1][0], float('inf')))
+        ((protocol, tag) for protocol, tags in inbounds.items() for tag in tags),
+        key=lambda x: index.get(x[1], float('inf'))
+    )
 
-    for protocol, tags in inbounds:
+    for protocol, tag in inbounds:
         settings = proxies.get(protocol)
         if not settings:
             continue
+        inbound = xray.config.inbounds_by_tag.get(tag)
+        if not inbound:
+            continue
 
-        format_variables.update({"PROTOCOL": protocol.name})
-        for tag in tags:
-            inbound = xray.config.inbounds_by_tag.get(tag)
-            if not inbound:
-                continue
-
-            format_variables.update({"TRANSPORT": inbound["network"]})
-            host_inbound = inbound.copy()
-            for host in xray.hosts.get(tag, []):
-                sni = ""
-                sni_list = host["sni"] or inbound["sni"]
-                if sni_list:
-                    salt = secrets.token_hex(8)
-                    sni = random.choice(sni_list).replace("*", salt)
-
-                if sids := inbound.get("sids"):
-                    inbound["sid"] = random.choice(sids)
-
-                req_host = ""
-                req_host_list = host["host"] or inbound["host"]
-                if req_host_list:
-                    salt = secrets.token_hex(8)
-                    req_host = random.choice(req_host_list).replace("*", salt)
-
-                address = ""
-                address_list = host['address']
-                if host['address']:
-                    salt = secrets.token_hex(8)
-                    address = random.choice(address_list).replace('*', salt)
-
-                if host["path"] is not None:
-                    path = host["path"].format_map(format_variables)
-                else:
-                    path = inbound.get("path", "").format_map(format_variables)
-
-                if host.get("use_sni_as_host", False) and sni:
-                    req_host = sni
-
-                host_inbound.update(
-                    {
-                        "port": host["port"] or inbound["port"],
-                        "sni": sni,
-                        "host": req_host,
-                        "tls": inbound["tls"] if host["tls"] is None else host["tls"],
-                        "alpn": host["alpn"] if host["alpn"] else None,
-                        "path": path,
-                        "fp": host["fingerprint"] or inbound.get("fp", ""),
-                        "ais": host["allowinsecure"]
-                        or inbound.get("allowinsecure", ""),
-                        "mux_enable": host["mux_enable"],
-                        "fragment_setting": host["fragment_setting"],
-                        "noise_setting": host["noise_setting"],
-                        "random_user_agent": host["random_user_agent"],
-                    }
-                )
-
-                conf.add(
-                    remark=host["remark"].format_map(format_variables),
-                    address=address.format_map(format_variables),
-                    inbound=host_inbound,
-                    settings=settings.model_dump()
-                )
+        settings = settings.model_dump()
+        format_variables.update({"PROTOCOL": protocol.name, "TRANSPORT": inbound["network"]})
+        for host in plan.get(tag, []):
+            # the wildcards are replaced by a random salt
+            sni = pick(host["sni"])
+            if "*" in sni:
+                sni = sni.replace("*", secrets.token_hex(8))
+
+            sid = pick(host["sids"]) if host["sids"] else None
+
+            req_host = pick(host["host"])
+            if "*" in req_host:
+                req_host = req_host.replace("*", secrets.token_hex(8))
+
+            address = pick(host["address"])
+            if "*" in address:
+                address = address.replace("*", secrets.token_hex(8))
+            if host["address_format"]:
+                address = address.format_map(format_variables)
+
+            if host["use_sni_as_host"] and sni:
+                req_host = sni
+
+            host_inbound = {
+                **host["inbound"],
+                "sni": sni,
+                "host": req_host,
+                "path": host["path"].format_map(format_variables) if host["path_format"] else host["path"],
+            }
+            if sid is not None:
+                host_inbound["sid"] = sid
+
+            conf.add(
+                remark=host["remark"].format_map(format_variables) if host["remark_format"] else host["remark"],
+                address=address,
+                inbound=host_inbound,
+                settings=settings
+            )
 
     return conf.render(reverse=reverse)
 
@@ -1,12 +1,11 @@
-import copy
 import json
 from random import choice
 
 from app.utils.helpers import UUIDEncoder
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.subscription.funcs import copy_nested, get_grpc_gun
+from app.templates import load_template
 from config import (
     MUX_TEMPLATE,
     SINGBOX_SETTINGS_TEMPLATE,
@@ -19,9 +18,9 @@ class SingBoxConfiguration(str):
 
     def __init__(self):
         self.proxy_remarks = []
-        self.config = json.loads(render_template(SINGBOX_SUBSCRIPTION_TEMPLATE))
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.config = json.loads(load_template(SINGBOX_SUBSCRIPTION_TEMPLATE, str))
+        self.mux_template = load_template(MUX_TEMPLATE)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
@@ -29,7 +28,7 @@ class SingBoxConfiguration(str):
             self.user_agent_list = []
 
         try:
-            self.settings = json.loads(render_template(SINGBOX_SETTINGS_TEMPLATE))
+            self.settings = load_template(SINGBOX_SETTINGS_TEMPLATE)
         except TemplateNotFound:
             self.settings = {}
 
@@ -101,7 +100,7 @@ class SingBoxConfiguration(str):
         return config
 
     def http_config(self, host='', path='', random_user_agent: bool = False):
-        config = copy.deepcopy(self.settings.get("httpSettings", {
+        config = dict(self.settings.get("httpSettings", {
             "idle_timeout": "15s",
             "ping_timeout": "15s",
             "method": "GET",
@@ -116,24 +115,26 @@ class SingBoxConfiguration(str):
         if host:
             config["host"] = [host]
         if random_user_agent:
-            config["headers"]["User-Agent"] = choice(self.user_agent_list)
+            copy_nested(config, "headers")["User-Agent"] = choice(self.user_agent_list)
 
         return config
 
     def ws_config(self, host='', path='', random_user_agent: bool = False,
                   max_early_data=None, early_data_header_name=None):
-        config = copy.deepcopy(self.settings.get("wsSettings", {
+        config = dict(self.settings.get("wsSettings", {
             "headers": {}
         }))
         if "headers" not in config:
             config["headers"] = {}
+        if host or random_user_agent:
+            headers = copy_nested(config, "headers")
 
         if path:
             config["path"] = path
         if host:
-            config["headers"]["Host"] = host
+            headers["Host"] = host
         if random_user_agent:
-            config["headers"]["User-Agent"] = choice(self.user_agent_list)
+            headers["User-Agent"] = choice(self.user_agent_list)
         if max_early_data is not None:
             config["max_early_data"] = max_early_data
         if early_data_header_name:
@@ -142,7 +143,7 @@ class SingBoxConfiguration(str):
         return config
 
     def grpc_config(self, path=''):
-        config = copy.deepcopy(self.settings.get("grpcSettings", {}))
+        config = dict(self.settings.get("grpcSettings", {}))
 
         if path:
             config["service_name"] = path
@@ -150,7 +151,7 @@ class SingBoxConfiguration(str):
         return config
 
     def httpupgrade_config(self, host='', path='', random_user_agent: bool = False):
-        config = copy.deepcopy(self.settings.get("httpupgradeSettings", {
+        config = dict(self.settings.get("httpupgradeSettings", {
             "headers": {}
         }))
         if "headers" not in config:
@@ -160,7 +161,7 @@ class SingBoxConfiguration(str):
         if path:
             config["path"] = path
         if random_user_agent:
-            config["headers"]["User-Agent"] = choice(self.user_agent_list)
+            copy_nested(config, "headers")["User-Agent"] = choice(self.user_agent_list)
 
         return config
 
@@ -274,8 +275,8 @@ class SingBoxConfiguration(str):
                                             pbk=pbk, sid=sid, alpn=alpn,
                                             ais=ais)
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["sing-box"]
+        # the cached template is shared, so each proxy gets its own copy
+        mux_config = dict(self.mux_template["sing-box"])
 
         config['multiplex'] = mux_config
         if config['multiplex']["enabled"]:
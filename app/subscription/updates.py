@@ -0,0 +1,33 @@
+import threading
+from datetime import datetime
+from typing import Dict, Tuple
+
+
+class SubscriptionUpdates:
+    """
+    Last subscription update time and user agent of users, buffered in memory
+    and written to the database in bulk by a job, so a subscription request
+    doesn't write anything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._updates: Dict[int, Tuple[datetime, str]] = {}
+
+    def add(self, user_id: int, user_agent: str):
+        with self._lock:
+            self._updates[user_id] = (datetime.utcnow(), user_agent)
+
+    def pop(self) -> Dict[int, Tuple[datetime, str]]:
+        with self._lock:
+            updates, self._updates = self._updates, {}
+        return updates
+
+    def restore(self, updates: Dict[int, Tuple[datetime, str]]):
+        """Puts back updates that couldn't be written, unless newer ones were added meanwhile."""
+        with self._lock:
+            for user_id, update in updates.items():
+                self._updates.setdefault(user_id, update)
+
+
+sub_updates = SubscriptionUpdates()
@@ -1,5 +1,4 @@
 import base64
-import copy
 import json
 import urllib.parse as urlparse
 from random import choice
@@ -9,8 +8,8 @@ from uuid import UUID
 
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun, get_grpc_multi
-from app.templates import render_template
+from app.subscription.funcs import copy_nested, get_grpc_gun, get_grpc_multi
+from app.templates import load_template
 from app.utils.helpers import UUIDEncoder
 from config import (
     EXTERNAL_CONFIG,
@@ -489,16 +488,16 @@ class V2rayJsonConfig(str):
 
     def __init__(self):
         self.config = []
-        self.template = render_template(V2RAY_SUBSCRIPTION_TEMPLATE)
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.template = load_template(V2RAY_SUBSCRIPTION_TEMPLATE)
+        self.mux_template = load_template(MUX_TEMPLATE)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
         else:
             self.user_agent_list = []
 
-        grpc_user_agent_data = json.loads(render_template(GRPC_USER_AGENT_TEMPLATE))
+        grpc_user_agent_data = load_template(GRPC_USER_AGENT_TEMPLATE)
 
         if 'list' in grpc_user_agent_data and isinstance(grpc_user_agent_data['list'], list):
             self.grpc_user_agent_data = grpc_user_agent_data['list']
@@ -506,14 +505,15 @@ class V2rayJsonConfig(str):
             self.grpc_user_agent_data = []
 
         try:
-            self.settings = json.loads(render_template(V2RAY_SETTINGS_TEMPLATE))
+            self.settings = load_template(V2RAY_SETTINGS_TEMPLATE)
         except TemplateNotFound:
             self.settings = {}
 
         del user_agent_data, grpc_user_agent_data
 
     def add_config(self, remarks, outbounds):
-        json_template = json.loads(self.template)
+        # only the remarks and outbounds differ between configs, the rest of the template is shared
+        json_template = dict(self.template)
         json_template["remarks"] = remarks
         json_template["outbounds"] = outbounds + json_template["outbounds"]
         self.config.append(json_template)
@@ -563,7 +563,7 @@ class V2rayJsonConfig(str):
         return realitySettings
 
     def ws_config(self, path: str = "", host: str = "", random_user_agent: bool = False, heartbeatPeriod: int = 0) -> dict:
-        wsSettings = copy.deepcopy(self.settings.get("wsSettings", {}))
+        wsSettings = dict(self.settings.get("wsSettings", {}))
 
         if "headers" not in wsSettings:
             wsSettings["headers"] = {}
@@ -572,14 +572,14 @@ class V2rayJsonConfig(str):
         if host:
             wsSettings["host"] = host
         if random_user_agent:
-            wsSettings["headers"]["User-Agent"] = choice(self.user_agent_list)
+            copy_nested(wsSettings, "headers")["User-Agent"] = choice(self.user_agent_list)
         if heartbeatPeriod:
             wsSettings["heartbeatPeriod"] = heartbeatPeriod
 
         return wsSettings
 
     def httpupgrade_config(self, path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
-        httpupgradeSettings = copy.deepcopy(self.settings.get("httpupgradeSettings", {}))
+        httpupgradeSettings = dict(self.settings.get("httpupgradeSettings", {}))
 
         if "headers" not in httpupgradeSettings:
             httpupgradeSettings["headers"] = {}
@@ -588,8 +588,7 @@ class V2rayJsonConfig(str):
         if host:
             httpupgradeSettings["host"] = host
         if random_user_agent:
-            httpupgradeSettings["headers"]["User-Agent"] = choice(
-                self.user_agent_list)
+            copy_nested(httpupgradeSettings, "headers")["User-Agent"] = choice(self.user_agent_list)
 
         return httpupgradeSettings
 
@@ -603,7 +602,7 @@ class V2rayJsonConfig(str):
                          noGRPCHeader: bool = False,
                          keepAlivePeriod: int = 0,
                          ) -> dict:
-        config = copy.deepcopy(self.settings.get("splithttpSettings", {}))
+        config = dict(self.settings.get("splithttpSettings", {}))
 
         config["mode"] = mode
         if path:
@@ -611,8 +610,7 @@ class V2rayJsonConfig(str):
         if host:
             config["host"] = host
         if random_user_agent:
-            config["headers"]["User-Agent"] = choice(
-                self.user_agent_list)
+            copy_nested(config, "headers")["User-Agent"] = choice(self.user_agent_list)
         config.setdefault("scMaxEachPostBytes", sc_max_each_post_bytes)
         config.setdefault("scMaxConcurrentPosts", sc_max_concurrent_posts)
         config.setdefault("scMinPostsIntervalMs", sc_min_posts_interval_ms)
@@ -628,7 +626,7 @@ class V2rayJsonConfig(str):
 
     def grpc_config(self, path: str = "", host: str = "", multiMode: bool = False,
                     random_user_agent: bool = False) -> dict:
-        config = copy.deepcopy(self.settings.get("grpcSettings", {
+        config = dict(self.settings.get("grpcSettings", {
             "idle_timeout": 60,
             "health_check_timeout": 20,
             "permit_without_stream": False,
@@ -649,7 +647,7 @@ class V2rayJsonConfig(str):
 
     def tcp_config(self, headers="none", path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
         if headers == "http":
-            config = copy.deepcopy(self.settings.get("tcphttpSettings", {
+            config = dict(self.settings.get("tcphttpSettings", {
                 "header": {
                     "request": {
                         "headers": {
@@ -667,50 +665,46 @@ class V2rayJsonConfig(str):
                 }
             }))
         else:
-            config = copy.deepcopy(self.settings.get("tcpSettings", self.settings.get("rawSettings", {
+            config = dict(self.settings.get("tcpSettings", self.settings.get("rawSettings", {
                 "header": {
                     "type": "none"
                 }
             })))
-        if "header" not in config:
-            config["header"] = {}
+        header = copy_nested(config, "header")
 
         if headers:
-            config["header"]["type"] = headers
+            header["type"] = headers
 
         if any((path, host, random_user_agent)):
-            if "request" not in config["header"]:
-                config["header"]["request"] = {}
+            request = copy_nested(header, "request")
 
         if any((random_user_agent, host)):
-            if "headers" not in config["header"]["request"]:
-                config["header"]["request"]["headers"] = {}
+            request_headers = copy_nested(request, "headers")
 
         if path:
-            config["header"]["request"]["path"] = [path]
+            request["path"] = [path]
 
         if host:
-            config["header"]["request"]["headers"]["Host"] = [host]
+            request_headers["Host"] = [host]
 
         if random_user_agent:
-            config["header"]["request"]["headers"]["User-Agent"] = [
-                choice(self.user_agent_list)]
+            request_headers["User-Agent"] = [choice(self.user_agent_list)]
 
         return config
 
     def http_config(self, net="http", path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
         if net == "h2":
-            config = copy.deepcopy(self.settings.get("h2Settings", {
+            config = dict(self.settings.get("h2Settings", {
                 "header": {}
             }))
         elif net == "h3":
-            config = copy.deepcopy(self.settings.get("h3Settings", {
+            config = dict(self.settings.get("h3Settings", {
                 "header": {}
             }))
         else:
-            config = self.settings.get("httpSettings", {
+            config = dict(self.settings.get("httpSettings", {
                 "header": {}
-            })
+            }))
         if "header" not in config:
             config["header"] = {}
 
@@ -720,13 +714,12 @@ class V2rayJsonConfig(str):
         else:
             config["host"] = []
         if random_user_agent:
-            config["headers"]["User-Agent"] = [
-                choice(self.user_agent_list)]
+            copy_nested(config, "headers")["User-Agent"] = [choice(self.user_agent_list)]
 
         return config
 
     def quic_config(self, path=None, host=None, header=None) -> dict:
-        quicSettings = copy.deepcopy(self.settings.get("quicSettings", {
+        quicSettings = dict(self.settings.get("quicSettings", {
             "security": "none",
             "header": {
                 "type": "none"
@@ -741,12 +734,12 @@ class V2rayJsonConfig(str):
         if host:
             quicSettings["security"] = host
         if header:
-            quicSettings["header"]["type"] = header
+            copy_nested(quicSettings, "header")["type"] = header
 
         return quicSettings
 
     def kcp_config(self, seed=None, host=None, header=None) -> dict:
-        kcpSettings = copy.deepcopy(self.settings.get("kcpSettings", {
+        kcpSettings = dict(self.settings.get("kcpSettings", {
             "header": {
                 "type": "none"
             },
@@ -763,10 +756,12 @@ class V2rayJsonConfig(str):
 
         if seed:
             kcpSettings["seed"] = seed
+        if header or host:
+            kcp_header = copy_nested(kcpSettings, "header")
         if header:
-            kcpSettings["header"]["type"] = header
+            kcp_header["type"] = header
         if host:
-            kcpSettings["header"]["domain"] = host
+            kcp_header["domain"] = host
 
         return kcpSettings
 
@@ -1072,8 +1067,8 @@ class V2rayJsonConfig(str):
             keepAlivePeriod=inbound.get("keepAlivePeriod", 0),
         )
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["v2ray"]
+        # the cached template is shared, so each outbound gets its own copy
+        mux_config = dict(self.mux_template["v2ray"])
 
         if inbound.get('mux_enable', False):
             outbound["mux"] = mux_config
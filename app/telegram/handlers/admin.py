@@ -104,6 +104,24 @@ def cleanup_messages(chat_id: int) -> None:
     mem_store.set(f"{chat_id}:messages_to_delete", [])
 
 
+def push_bulk_status_changes(changes: dict) -> None:
+    """Adds the users activated by a bulk modification to the cores and removes the deactivated ones."""
+    removed = [user_id for status, user_ids in changes.items() if status != UserStatus.active for user_id in user_ids]
+    xray.operations.sync_users(changes.get(UserStatus.active, []), removed)
+
+
+def write_users_report(db, file_name: str, user_ids: list) -> None:
+    with open(file_name, 'w') as f:
+        f.write('USERNAME\tEXIPRY\tUSAGE/LIMIT\tSTATUS\n')
+        for user in crud.iter_users(db, user_ids):
+            f.write(
+                f'{user.username}\
+\t{datetime.fromtimestamp(user.expire) if user.expire else "never"}\
+\t{readable_size(user.used_traffic) if user.used_traffic else 0}\
+/{readable_size(user.data_limit) if user.data_limit else "Unlimited"}\
+\t{user.status}\n')
+
+
 @bot.message_handler(commands=['start', 'help'], is_admin=True)
 def help_command(message: types.Message):
     cleanup_messages(message.chat.id)
@@ -563,10 +581,20 @@ def edit_user_expire_step(message: types.Message, username: str):
 
 @bot.callback_query_handler(cb_query_startswith('users:'), is_admin=True)
 def users_command(call: types.CallbackQuery):
-    page = int(call.data.split(':')[1]) if len(call.data.split(':')) > 1 else 1
+    args = call.data.split(':')
+    page = int(args[1]) if len(args) > 1 else 1
+    sort = [crud.UsersSortingOptions["-created_at"]]
     with GetDB() as db:
-        total_pages = math.ceil(crud.get_users_count(db) / 10)
-        users = crud.get_users(db, offset=(page - 1) * 10, limit=10, sort=[crud.UsersSortingOptions["-created_at"]])
+        total_pages = math.ceil(crud.count_users(db, approximate=True) / 10)
+        # the pager points at the user next to the page (n<id>: after it, p<id>: before it), so it doesn't
+        # skip all the users of the previous pages, or at the page number if that user is gone
+        cursor = None
+        if len(args) > 2 and args[2][1:].isdigit() and (dbuser := crud.get_user_by_id(db, int(args[2][1:]))):
+            cursor = crud.encode_users_cursor(dbuser, sort, backward=args[2][0] == 'p')
+        if cursor:
+            users = crud.get_users(db, limit=10, sort=sort, cursor=cursor)
+        else:
+            users = crud.get_users(db, offset=(page - 1) * 10, limit=10, sort=sort)
         text = """👥 Users: (Page {page}/{total_pages})
 ✅ Active
 ❌ Disabled
@@ -1591,11 +1619,11 @@ def confirm_user_command(call: types.CallbackQuery):
     elif data == 'restart':
         m = bot.edit_message_text(
             '🔄 Restarting XRay core...', call.message.chat.id, call.message.message_id)
-        config = xray.config.include_db_users()
+        config = xray.config.include_db_users(reload=True)
         xray.core.restart(config)
         for node_id, node in list(xray.nodes.items()):
             if node.connected:
-                xray.operations.restart_node(node_id, config)
+                xray.operations.restart_node(node_id)
         bot.edit_message_text(
             '✅ XRay core restarted successfully.',
             m.chat.id, m.message_id,
@@ -1955,30 +1983,20 @@ def confirm_user_command(call: types.CallbackQuery):
         schedule_delete_message(
             call.message.chat.id,
             bot.send_message(chat_id, '⏳ <b>In Progress...</b>', 'HTML').id)
-        data_limit = float(call.data.split(":")[2]) * 1024 * 1024 * 1024
+        data_limit = int(float(call.data.split(":")[2]) * 1024 * 1024 * 1024)
         with GetDB() as db:
-            users = crud.get_users(db)
-            counter = 0
+            user_ids, changes = crud.bulk_modify_users(
+                db, data_limit=data_limit,
+                status=[UserStatus.active, UserStatus.on_hold, UserStatus.disabled])
+            push_bulk_status_changes(changes)
+            counter = len(user_ids)
+            total = crud.count_users(db)
             file_name = f'new_data_limit_users_{int(now.timestamp()*1000)}.txt'
-            with open(file_name, 'w') as f:
-                f.write('USERNAME\tEXIPRY\tUSAGE/LIMIT\tSTATUS\n')
-                for user in users:
-                    try:
-                        if user.data_limit and user.status not in [UserStatus.limited, UserStatus.expired]:
-                            user = crud.update_user(db, user, UserModify(data_limit=(user.data_limit + data_limit)))
-                            counter += 1
-                            f.write(
-                                f'{user.username}\
-\t{datetime.fromtimestamp(user.expire) if user.expire else "never"}\
-\t{readable_size(user.used_traffic) if user.used_traffic else 0}\
-/{readable_size(user.data_limit) if user.data_limit else "Unlimited"}\
-\t{user.status}\n')
-                    except sqlalchemy.exc.IntegrityError:
-                        db.rollback()
+            write_users_report(db, file_name, user_ids)
             cleanup_messages(chat_id)
             bot.send_message(
                 chat_id,
-                f'✅ <b>{counter}/{len(users)} Users</b> Data Limit according to <code>{"+" if data_limit >
+                f'✅ <b>{counter}/{total} Users</b> Data Limit according to <code>{"+" if data_limit >
                                                                                        0 else "-"}{readable_size(abs(data_limit))}</code>',
                 'HTML',
                 reply_markup=BotKeyboard.main_menu())
@@ -2003,32 +2021,18 @@ def confirm_user_command(call: types.CallbackQuery):
             bot.send_message(chat_id, '⏳ <b>In Progress...</b>', 'HTML').id)
         days = int(call.data.split(":")[2])
         with GetDB() as db:
-            users = crud.get_users(db)
-            counter = 0
+            user_ids, changes = crud.bulk_modify_users(
+                db, expire=days * 86400,
+                status=[UserStatus.active, UserStatus.on_hold, UserStatus.disabled])
+            push_bulk_status_changes(changes)
+            counter = len(user_ids)
+            total = crud.count_users(db)
             file_name = f'new_expiry_users_{int(now.timestamp()*1000)}.txt'
-            with open(file_name, 'w') as f:
-                f.write('USERNAME\tEXIPRY\tUSAGE/LIMIT\tSTATUS\n')
-                for user in users:
-                    try:
-                        if user.expire and user.status not in [UserStatus.limited, UserStatus.expired]:
-                            user = crud.update_user(
-                                db, user,
-                                UserModify(
-                                    expire=int(
-                                        (datetime.fromtimestamp(user.expire) + relativedelta(days=days)).timestamp())))
-                            counter += 1
-                            f.write(
-                                f'{user.username}\
-\t{datetime.fromtimestamp(user.expire) if user.expire else "never"}\
-\t{readable_size(user.used_traffic) if user.used_traffic else 0}\
-/{readable_size(user.data_limit) if user.data_limit else "Unlimited"}\
-\t{user.status}\n')
-                    except sqlalchemy.exc.IntegrityError:
-                        db.rollback()
+            write_users_report(db, file_name, user_ids)
             cleanup_messages(chat_id)
             bot.send_message(
                 chat_id,
-                f'✅ <b>{counter}/{len(users)} Users</b> Expiry Changes according to {days} Days',
+                f'✅ <b>{counter}/{total} Users</b> Expiry Changes according to {days} Days',
                 'HTML',
                 reply_markup=BotKeyboard.main_menu())
             if TELEGRAM_LOGGER_CHANNEL_ID:
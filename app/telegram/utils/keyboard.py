@@ -237,6 +237,7 @@ class BotKeyboard:
     @staticmethod
     def user_list(users: list, page: int, total_pages: int):
         keyboard = types.InlineKeyboardMarkup()
+        first_id, last_id = (users[0].id, users[-1].id) if users else ('', '')
         if len(users) >= 2:
             users = [p for p in users]
             users = [users[i:i + 2] for i in range(0, len(users), 2)]
@@ -263,14 +264,14 @@ class BotKeyboard:
                 keyboard.add(
                     types.InlineKeyboardButton(
                         text="⬅️ Previous",
-                        callback_data=f'users:{page - 1}'
+                        callback_data=f'users:{page - 1}:p{first_id}'
                     )
                 )
             if page < total_pages:
                 keyboard.add(
                     types.InlineKeyboardButton(
                         text="➡️ Next",
-                        callback_data=f'users:{page + 1}'
+                        callback_data=f'users:{page + 1}:n{last_id}'
                     )
                 )
         keyboard.add(
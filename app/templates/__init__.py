@@ -1,5 +1,6 @@
+import json
 from datetime import datetime
-from typing import Union
+from typing import Any, Callable, Dict, Tuple, Union
 
 import jinja2
 
@@ -19,3 +20,32 @@ env.globals['now'] = datetime.utcnow
 
 def render_template(template: str, context: Union[dict, None] = None) -> str:
     return env.get_template(template).render(context or {})
+
+
+# what was built from the templates, along with the compiled template it was built from
+_built_templates: Dict[Tuple[str, Callable], Tuple[jinja2.Template, Any]] = {}
+
+
+def _build(template: str, key: Callable, build: Callable[[jinja2.Template], Any]) -> Any:
+    compiled = env.get_template(template)
+    cached = _built_templates.get((template, key))
+    if cached is None or cached[0] is not compiled:
+        cached = _built_templates[(template, key)] = (compiled, build(compiled))
+    return cached[1]
+
+
+def build_template(template: str, build: Callable[[jinja2.Template], Any]) -> Any:
+    """
+    Returns what ``build`` makes of a compiled template.
+
+    The result is kept as long as Jinja keeps the compiled template, which it reloads
+    once the modification time of its file changes, so editing a template still
+    takes effect without a restart. It's shared by every caller and must be copied
+    before being modified.
+    """
+    return _build(template, build, build)
+
+
+def load_template(template: str, parse: Callable[[str], Any] = json.loads) -> Any:
+    """Returns a template rendered without a context and parsed by ``parse``, kept like ``build_template``'s."""
+    return _build(template, parse, lambda compiled: parse(compiled.render()))
@@ -5,7 +5,7 @@ from datetime import datetime, timedelta
 from functools import lru_cache
 from hashlib import sha256
 from math import ceil
-from typing import Union
+from typing import Tuple, Union
 
 
 from config import JWT_ACCESS_TOKEN_EXPIRE_MINUTES
@@ -57,7 +57,8 @@ def create_subscription_token(username: str) -> str:
     return data_final
 
 
-def get_subscription_payload(token: str) -> Union[dict, None]:
+@lru_cache(maxsize=65536)
+def _verify_subscription_token(token: str) -> Union[Tuple[str, datetime], None]:
     try:
         if len(token) < 15:
             return
@@ -65,7 +66,7 @@ def get_subscription_payload(token: str) -> Union[dict, None]:
         if token.startswith("eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9."):
             payload = jwt.decode(token, get_secret_key(), algorithms=["HS256"])
             if payload.get("access") == "subscription":
-                return {"username": payload['sub'], "created_at": datetime.utcfromtimestamp(payload['iat'])}
+                return payload['sub'], datetime.utcfromtimestamp(payload['iat'])
             else:
                 return
         else:
@@ -83,8 +84,15 @@ def get_subscription_payload(token: str) -> Union[dict, None]:
             if u_signature == u_token_resign:
                 u_username = u_token_dec_str.split(',')[0]
                 u_created_at = int(u_token_dec_str.split(',')[1])
-                return {"username": u_username, "created_at": datetime.utcfromtimestamp(u_created_at)}
+                return u_username, datetime.utcfromtimestamp(u_created_at)
             else:
                 return
     except jwt.exceptions.PyJWTError:
         return
+
+
+def get_subscription_payload(token: str) -> Union[dict, None]:
+    # verifying a token doesn't depend on anything else, so recent results are reused
+    verified = _verify_subscription_token(token)
+    if verified:
+        return {"username": verified[0], "created_at": verified[1]}
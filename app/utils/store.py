@@ -46,6 +46,7 @@ class DictStorage(dict):
     def __init__(self, update_func):
         super().__init__()
         self.update_func = update_func
+        self.version = 0  # incremented on every update, to invalidate what's derived from the data
 
     def __getitem__(self, key):
         if not self:
@@ -85,3 +86,4 @@ class DictStorage(dict):
 
     def update(self):
         self.update_func(self)
+        self.version += 1
@@ -0,0 +1,278 @@
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Set, Tuple
+
+from config import USER_USAGES_JOURNAL_PATH, USERS_ONLINE_AT_GRANULARITY
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+# (node id, hour timestamp, user id, used traffic), node id 0 is the main core
+_RECORD = struct.Struct('<qqqq')
+# users' admins are looked up again after this many seconds, for the owners changed by other processes
+USER_ADMINS_MAX_AGE = 3600
+
+
+def current_hour() -> datetime:
+    return datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
+
+
+class UsageAccumulator:
+    """
+    Write-behind buffer of users' traffic.
+
+    Usages are summed per node, hour and user in memory, so polling the cores
+    often only costs memory, and they're persisted in bulk by ``flush``. Every
+    ``add`` is appended to a journal file first, so the buffered traffic can be
+    recovered if the panel stops before flushing.
+    """
+
+    def __init__(self, journal_path: Optional[str] = None):
+        self.journal_path = journal_path
+        self._buckets: Dict[Tuple[int, int], Dict[int, int]] = {}
+        self._lock = threading.Lock()
+        self._journal = None
+
+    @property
+    def _flushing_journal_path(self):
+        return f"{self.journal_path}.flushing"
+
+    def _open_journal(self):
+        if self.journal_path and self._journal is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+            self._journal = open(self.journal_path, 'ab')
+        return self._journal
+
+    def _write_journal(self, records: bytes):
+        journal = self._open_journal()
+        if journal is None or not records:
+            return
+        journal.write(records)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _add(self, node_id: int, hour: int, usages: Dict[int, int]):
+        bucket = self._buckets.setdefault((node_id, hour), {})
+        for uid, value in usages.items():
+            bucket[uid] = bucket.get(uid, 0) + value
+
+    def add(self, node_id: Optional[int], usages: Dict[int, int], hour: Optional[datetime] = None):
+        """Adds the traffic of ``usages`` (user id → bytes) used on the node."""
+        usages = {uid: value for uid, value in usages.items() if value}
+        if not usages:
+            return
+
+        node_id = node_id or 0
+        hour = int((hour or current_hour()).replace(tzinfo=timezone.utc).timestamp())
+        records = b''.join(_RECORD.pack(node_id, hour, uid, value) for uid, value in usages.items())
+
+        with self._lock:
+            self._write_journal(records)
+            self._add(node_id, hour, usages)
+
+    def _rewrite_journal(self):
+        """Replaces the journals with one holding exactly what is buffered in memory."""
+        if not self.journal_path:
+            return
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        tmp_path = f"{self.journal_path}.tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(tmp_path)), exist_ok=True)
+        with open(tmp_path, 'wb') as file:
+            for (node_id, hour), usages in self._buckets.items():
+                file.write(b''.join(_RECORD.pack(node_id, hour, uid, value) for uid, value in usages.items()))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+        try:
+            os.remove(self._flushing_journal_path)
+        except FileNotFoundError:
+            pass
+
+    def recover(self):
+        """Loads the traffic left in the journals by a previous run into memory."""
+        if not self.journal_path:
+            return
+
+        with self._lock:
+            for path in (self._flushing_journal_path, self.journal_path):
+                try:
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                except FileNotFoundError:
+                    continue
+
+                usages = defaultdict(dict)
+                # a crash in the middle of a write may leave a partial record at the end
+                for node_id, hour, uid, value in _RECORD.iter_unpack(data[:len(data) - len(data) % _RECORD.size]):
+                    usages[(node_id, hour)][uid] = usages[(node_id, hour)].get(uid, 0) + value
+
+                for (node_id, hour), bucket_usages in usages.items():
+                    self._add(node_id, hour, bucket_usages)
+
+            self._rewrite_journal()
+
+    @contextmanager
+    def flush(self):
+        """
+        Hands the buffered usages over as ``{(node id, hour timestamp): {user id: bytes}}``
+        and forgets them once the block exits; they're put back if it raises.
+
+        The journal of the flushed usages is removed only after the block succeeds,
+        so a crash while persisting them may count them twice, but never loses them.
+        """
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self.journal_path and os.path.exists(self.journal_path):
+                os.replace(self.journal_path, self._flushing_journal_path)
+
+        try:
+            yield buckets
+        except BaseException:
+            with self._lock:
+                for (node_id, hour), usages in buckets.items():
+                    self._add(node_id, hour, usages)
+                self._rewrite_journal()
+            raise
+
+        if self.journal_path:
+            try:
+                os.remove(self._flushing_journal_path)
+            except FileNotFoundError:
+                pass
+
+
+class ReviewQueue:
+    """
+    Ids of the users whose limits must be checked by the next review, i.e. users
+    whose usage was just recorded or who have been modified since the last one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_ids: Set[int] = set()
+        self._everyone = True  # the first review checks everyone
+
+    def add(self, *user_ids: int):
+        with self._lock:
+            self._user_ids.update(user_ids)
+
+    def add_all(self):
+        """Makes the next review check every user, for changes made in bulk."""
+        with self._lock:
+            self._everyone = True
+
+    def pop(self) -> Optional[Set[int]]:
+        """Returns the queued ids and empties the queue, ``None`` means every user."""
+        with self._lock:
+            user_ids, self._user_ids = self._user_ids, set()
+            everyone, self._everyone = self._everyone, False
+        return None if everyone else user_ids
+
+
+class UserAdmins:
+    """
+    Ids of the users' admins, to attribute the users' usages to them.
+
+    Users are looked up the first time their usage is recorded, and the creation,
+    deletion and owner changes of users made through crud update the index.
+    """
+
+    def __init__(self):
+        self._admin_ids: Dict[int, Optional[int]] = {}
+        self._lock = threading.Lock()
+        self._expires_at = time.monotonic() + USER_ADMINS_MAX_AGE
+
+    def set(self, user_id: int, admin_id: Optional[int]):
+        with self._lock:
+            self._admin_ids[user_id] = admin_id
+
+    def discard(self, *user_ids: int):
+        with self._lock:
+            for user_id in user_ids:
+                self._admin_ids.pop(user_id, None)
+
+    def discard_admin(self, admin_id: int):
+        """Forgets the users of a removed admin, they no longer have one."""
+        with self._lock:
+            for user_id in [u for u, a in self._admin_ids.items() if a == admin_id]:
+                self._admin_ids[user_id] = None
+
+    def get_many(self, db: "Session", user_ids: Iterable[int]) -> Dict[int, Optional[int]]:
+        """Returns the admin id (or ``None``) of each existing user of ``user_ids``."""
+        from app.db.models import User
+
+        with self._lock:
+            if time.monotonic() > self._expires_at:
+                self._admin_ids.clear()
+                self._expires_at = time.monotonic() + USER_ADMINS_MAX_AGE
+            admin_ids = {uid: self._admin_ids[uid] for uid in user_ids if uid in self._admin_ids}
+
+        missing = sorted(uid for uid in user_ids if uid not in admin_ids)
+        for i in range(0, len(missing), 1000):
+            found = dict(db.query(User.id, User.admin_id).filter(User.id.in_(missing[i:i + 1000])))
+            admin_ids.update(found)
+            with self._lock:
+                self._admin_ids.update(found)
+
+        return admin_ids
+
+
+class LastSeen:
+    """
+    Last time each user had traffic.
+
+    It's kept in memory so ``users.online_at`` is only written when it has moved forward
+    by at least ``granularity`` seconds, the exact time is read from here instead.
+    """
+
+    def __init__(self, granularity: int):
+        self.granularity = granularity
+        self._seen: Dict[int, datetime] = {}
+        self._written: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+
+    def online_at(self, user_id: int, online_at: Optional[datetime]) -> Optional[datetime]:
+        """Returns the latest of the ``online_at`` stored for a user and the time it was last seen."""
+        seen = self._seen.get(user_id)
+        if seen is None or (online_at and online_at > seen):
+            return online_at
+        return seen
+
+    def add(self, user_ids: Iterable[int], seen_at: datetime) -> Set[int]:
+        """Records that users were seen, and returns those whose ``online_at`` must be written."""
+        to_write = set()
+        with self._lock:
+            for user_id in user_ids:
+                self._seen[user_id] = seen_at
+                written = self._written.get(user_id)
+                if written is None or (seen_at - written).total_seconds() >= self.granularity:
+                    to_write.add(user_id)
+        return to_write
+
+    def written(self, user_ids: Iterable[int], online_at: datetime):
+        """Records that ``online_at`` was written for users, once the transaction is committed."""
+        with self._lock:
+            for user_id in user_ids:
+                self._written[user_id] = online_at
+
+
+# held while users' usage records are written, so a rollup never deletes records a flush is adding to
+user_usages_write_lock = threading.Lock()
+
+user_usages = UsageAccumulator(USER_USAGES_JOURNAL_PATH)
+users_to_review = ReviewQueue()
+user_admins = UserAdmins()
+users_last_seen = LastSeen(USERS_ONLINE_AT_GRANULARITY)
@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from xray_api import XRay as XRayAPI
+
+# number of threads shared by the collectors, so each core is queried concurrently
+MAX_WORKERS = 32
+# upper bounds (in seconds) of the collection latency histogram buckets, the last one is unbounded
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="xray-stats")
+
+collectors: Dict[str, "StatsCollector"] = {}
+
+
+class StatsCollector:
+    """
+    Fetches stats from all cores concurrently and waits for them until a deadline.
+
+    The stats are reset on the cores once they're fetched, so a core that misses
+    the deadline isn't asked again until its pending result has arrived, and that
+    result is returned by the next ``collect`` instead of being dropped.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[XRayAPI], list]):
+        self.name = name
+        self.fetch = fetch
+        self.histograms: Dict[Optional[int], List[int]] = {}
+        self.late: Dict[Optional[int], int] = {}
+
+        self._pending: Dict[Optional[int], Future] = {}
+        self._lock = threading.Lock()
+
+        collectors[name] = self
+
+    def _observe(self, node_id: Optional[int], latency: float):
+        with self._lock:
+            histogram = self.histograms.setdefault(node_id, [0] * (len(LATENCY_BUCKETS) + 1))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-1] += 1
+
+    def _run(self, node_id: Optional[int], api: XRayAPI) -> list:
+        start = time.perf_counter()
+        try:
+            return self.fetch(api)
+        finally:
+            self._observe(node_id, time.perf_counter() - start)
+
+    def collect(self, apis: Dict[Optional[int], XRayAPI], deadline: float) -> Dict[Optional[int], list]:
+        """
+        Returns the stats of each core (``None`` is the main core) that were fetched before
+        ``deadline`` seconds, plus those of cores which were late on the previous calls.
+        """
+        for node_id, api in apis.items():
+            if node_id not in self._pending:
+                self._pending[node_id] = executor.submit(self._run, node_id, api)
+
+        _, not_done = wait(self._pending.values(), timeout=deadline)
+
+        results = {}
+        for node_id, future in list(self._pending.items()):
+            if future in not_done:
+                self.late[node_id] = self.late.get(node_id, 0) + 1
+                continue
+
+            del self._pending[node_id]
+            try:
+                results[node_id] = future.result()
+            except Exception:
+                results[node_id] = []
+
+        return results
+
+    def get_stats(self) -> Dict[Optional[int], dict]:
+        """Returns the collection latency histogram and the number of missed deadlines of each core."""
+        with self._lock:
+            return {
+                node_id: {
+                    "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], histogram)),
+                    "count": sum(histogram),
+                    "late": self.late.get(node_id, 0),
+                } for node_id, histogram in self.histograms.items()
+            }
@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import json
+import threading
 from collections import defaultdict
 from copy import deepcopy
 from pathlib import PosixPath
-from typing import Union
+from typing import Dict, Iterator, List, Tuple, Union
 
 import commentjson
 from sqlalchemy import func
@@ -26,6 +27,95 @@ def merge_dicts(a, b):  # B will override A dictionary key and values
     return a
 
 
+def make_client(inbound: dict, user_id: int, username: str, settings: dict) -> dict:
+    """Returns the client of a user's proxy ``settings`` in the ``inbound``, as it's put in the config."""
+    client = {
+        "email": f"{user_id}.{username}",
+        **settings
+    }
+
+    # XTLS currently only supports transmission methods of TCP and mKCP
+    if client.get('flow') and (
+            inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
+            or
+            (
+                inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
+                and
+                inbound.get('tls') not in ('tls', 'reality')
+            )
+            or
+            inbound.get('header_type') == 'http'
+    ):
+        del client['flow']
+
+    return client
+
+
+class ClientsTable:
+    """
+    The clients of active users per inbound, loaded from the database once and
+    then kept up to date as users are added, modified and removed, so a config
+    including the users is built without querying them again.
+    """
+
+    def __init__(self, config: XRayConfig):
+        self.config = config
+        self._inbounds: Dict[str, Dict[int, dict]] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def __deepcopy__(self, memo):
+        # the copies of a config are sent to the cores, they don't need the clients
+        return ClientsTable(deepcopy(self.config, memo))
+
+    def load(self):
+        """(Re)loads the clients of all active users from the database."""
+        with self._lock:
+            inbounds = defaultdict(dict)
+            for clients in self.config.iter_db_clients():
+                for inbound_tag, client in clients:
+                    inbounds[inbound_tag][int(client['email'].split('.', 1)[0])] = client
+
+            self._inbounds = dict(inbounds)
+            self._loaded = True
+
+    def invalidate(self):
+        """Makes the next access reload the clients, after users are changed in bulk."""
+        with self._lock:
+            self._loaded = False
+
+    def get(self, inbound_tag: str) -> List[dict]:
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            return list(self._inbounds.get(inbound_tag, {}).values())
+
+    def set_user(self, dbuser: "db_models.User") -> Dict[str, dict]:
+        """Replaces the clients of a user with the ones of its current proxies, and returns them by inbound tag."""
+        clients = {}
+        for proxy in dbuser.proxies:
+            excluded_inbound_tags = {inbound.tag for inbound in proxy.excluded_inbounds}
+            for inbound in self.config.inbounds_by_protocol.get(proxy.type, []):
+                if inbound['tag'] in excluded_inbound_tags:
+                    continue
+                clients[inbound['tag']] = make_client(inbound, dbuser.id, dbuser.username, proxy.settings)
+
+        with self._lock:
+            if not self._loaded:
+                return clients
+            for inbound_tag, inbound_clients in self._inbounds.items():
+                if inbound_tag not in clients:
+                    inbound_clients.pop(dbuser.id, None)
+            for inbound_tag, client in clients.items():
+                self._inbounds.setdefault(inbound_tag, {})[dbuser.id] = client
+        return clients
+
+    def remove_user(self, user_id: int):
+        with self._lock:
+            for inbound_clients in self._inbounds.values():
+                inbound_clients.pop(user_id, None)
+
+
 class XRayConfig(dict):
     def __init__(self,
                  config: Union[dict, str, PosixPath] = {},
@@ -61,6 +151,8 @@ class XRayConfig(dict):
 
         self._apply_api()
 
+        self.clients = ClientsTable(self)
+
     def _apply_api(self):
         api_inbound = self.get_inbound("API_INBOUND")
         if api_inbound:
@@ -358,9 +450,11 @@ class XRayConfig(dict):
     def copy(self):
         return deepcopy(self)
 
-    def include_db_users(self) -> XRayConfig:
-        config = self.copy()
-
+    def iter_db_clients(self, chunk_size: int = 1000) -> Iterator[List[Tuple[str, dict]]]:
+        """
+        Yields the clients of active and on-hold users as ``(inbound tag, client)``
+        pairs, in chunks of the clients of ``chunk_size`` proxies.
+        """
         with GetDB() as db:
             query = db.query(
                 db_models.User.id,
@@ -381,53 +475,39 @@ class XRayConfig(dict):
                 db_models.User.username,
                 db_models.Proxy.settings,
             )
-            result = query.all()
 
-            grouped_data = defaultdict(list)
-
-            for row in result:
-                grouped_data[row.type].append((
-                    row.id,
-                    row.username,
-                    row.settings,
-                    [i for i in row.excluded_inbound_tags.split(',') if i] if row.excluded_inbound_tags else None
-                ))
-
-            for proxy_type, rows in grouped_data.items():
-
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
+            clients = []
+            for row in query.yield_per(chunk_size):
+                inbounds = self.inbounds_by_protocol.get(row.type)
                 if not inbounds:
                     continue
 
+                excluded_inbound_tags = row.excluded_inbound_tags.split(',') if row.excluded_inbound_tags else ()
                 for inbound in inbounds:
-                    clients = config.get_inbound(inbound['tag'])['settings']['clients']
-
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
-                            continue
-
-                        client = {
-                            "email": f"{user_id}.{username}",
-                            **settings
-                        }
-
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get('flow') and (
-                                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
-                                or
-                                (
-                                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
-                                    and
-                                    inbound.get('tls') not in ('tls', 'reality')
-                                )
-                                or
-                                inbound.get('header_type') == 'http'
-                        ):
-                            del client['flow']
-
-                        clients.append(client)
+                    if inbound['tag'] in excluded_inbound_tags:
+                        continue
+
+                    clients.append((inbound['tag'], make_client(inbound, row.id, row.username, row.settings)))
+
+                if len(clients) >= chunk_size:
+                    yield clients
+                    clients = []
+
+            if clients:
+                yield clients
+
+    def include_db_users(self, reload: bool = False) -> XRayConfig:
+        """
+        Returns a copy of the config with the clients of active users in its inbounds,
+        ``reload`` reads them from the database again instead of using the ``clients`` table.
+        """
+        if reload:
+            self.clients.load()
+
+        config = self.copy()
+        for inbound in config['inbounds']:
+            if inbound['tag'] in self.inbounds_by_tag:
+                inbound['settings']['clients'] += self.clients.get(inbound['tag'])
 
         if DEBUG:
             with open('generated_config-debug.json', 'w') as f:
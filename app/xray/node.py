@@ -76,6 +76,7 @@ class ReSTXRayNode:
 
         self._api = None
         self._started = False
+        self._healthy = False  # result of the last request to the node, refreshed by heartbeat()
 
     def _prepare_config(self, config: XRayConfig):
         for inbound in config.get("inbounds", []):
@@ -116,18 +117,29 @@ class ReSTXRayNode:
 
     @property
     def connected(self):
+        return bool(self._session_id) and self._healthy
+
+    @property
+    def started(self):
+        return self._started
+
+    def heartbeat(self):
+        """Refreshes the connection and core state read by ``connected`` and ``started``."""
         if not self._session_id:
-            return False
+            self._healthy = False
+            return
+
         try:
             self.make_request("/ping", timeout=3)
-            return True
+            res = self.make_request("/", timeout=3)
         except NodeAPIError:
-            return False
+            self._healthy = False
+            return
 
-    @property
-    def started(self):
-        res = self.make_request("/", timeout=3)
-        return res.get('started', False)
+        self._healthy = True
+        if not res.get('started', False):
+            self._started = False
+            self._api = None
 
     @property
     def api(self):
@@ -154,8 +166,10 @@ class ReSTXRayNode:
 
         res = self.make_request("/connect", timeout=3)
         self._session_id = res['session_id']
+        self._healthy = True
 
     def disconnect(self):
+        self._healthy = False
         self.make_request("/disconnect", timeout=3)
         self._session_id = None
 
@@ -362,6 +376,10 @@ class RPyCXRayNode:
             self.disconnect()
             return False
 
+    def heartbeat(self):
+        # the connection is checked by a ping over the existing channel on every access
+        self.connected
+
     @property
     def remote(self):
         if not self.connected:
@@ -1,15 +1,19 @@
+import time
 from functools import lru_cache
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 from sqlalchemy.exc import SQLAlchemyError
 
 from app import logger, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
+from app.models.proxy import ProxyTypes
 from app.models.user import UserResponse
 from app.utils.concurrency import threaded_function
+from app.utils.usage import users_to_review
 from app.xray.node import XRayNode
-from xray_api import XRay as XRayAPI
+from app.xray.queue import ADD, ALTER, REMOVE, OperationsQueue
+from config import XRAY_BULK_SYNC_MAX_USERS
 from xray_api.types.account import Account, XTLSFlows
 
 if TYPE_CHECKING:
@@ -28,124 +32,174 @@ def get_tls():
         }
 
 
-@threaded_function
-def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
+_queues: Dict[Optional[int], OperationsQueue] = {}
 
 
-@threaded_function
-def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
+def _get_queue(node_id: Optional[int]) -> OperationsQueue:
+    """Returns the operations queue of a node, ``None`` is the main core."""
+    try:
+        return _queues[node_id]
+    except KeyError:
+        if node_id is None:
+            queue = OperationsQueue(lambda: xray.api)
+        else:
+            queue = OperationsQueue(lambda: xray.nodes[node_id].api,
+                                    on_error=lambda err: _resync_node(node_id, err))
+        return _queues.setdefault(node_id, queue)
+
+
+def _resync_node(node_id: int, err: Exception):
+    """
+    Disconnects a node that missed operations of its users, so the health check
+    connects it again and adds all of them.
+    """
+    node = xray.nodes.get(node_id)
+    if not node or not node.connected or not node.started:
+        return  # all users are added once it's (re)connected and started
+
+    _change_node_status(node_id, NodeStatus.error, message=f"Unable to sync users: {err}")
     try:
-        api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
+        node.disconnect()
+    except Exception:
         pass
 
 
-@threaded_function
-def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=account.email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
+def _queue_operation(action: str, inbound_tag: str, email: str, account: Account = None):
+    _get_queue(None).put(action, inbound_tag, email, account)  # main core
+    for node_id, node in list(xray.nodes.items()):
+        # the other nodes get all users once they're (re)connected and started
+        if node.connected and node.started:
+            _get_queue(node_id).put(action, inbound_tag, email, account)
+
+
+def get_queues_stats() -> Dict[Optional[int], dict]:
+    """Returns the queue depth and latencies (in seconds) of the operations queue of each core."""
+    return {
+        node_id: {
+            "queue_depth": queue.depth,
+            "processed": queue.processed,
+            "last_latency": queue.last_latency,
+            "average_latency": queue.average_latency,
+        } for node_id, queue in list(_queues.items())
+    }
+
+
+def _get_account(user: UserResponse, proxy_type: ProxyTypes, inbound_tag: str, email: str) -> Account:
+    inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
+
     try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
+        proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
+    except KeyError:
         pass
+    account = proxy_type.account_model(email=email, **proxy_settings)
+
+    # XTLS currently only supports transmission methods of TCP and mKCP
+    if getattr(account, 'flow', None) and (
+        inbound.get('network', 'tcp') not in ('tcp', 'kcp')
+        or
+        (
+            inbound.get('network', 'tcp') in ('tcp', 'kcp')
+            and
+            inbound.get('tls') not in ('tls', 'reality')
+        )
+        or
+        inbound.get('header_type') == 'http'
+    ):
+        account.flow = XTLSFlows.NONE
+
+    return account
 
 
 def add_user(dbuser: "DBUser"):
     user = UserResponse.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
+    users_to_review.add(dbuser.id)
+    xray.config.clients.set_user(dbuser)
 
     for proxy_type, inbound_tags in user.inbounds.items():
         for inbound_tag in inbound_tags:
-            inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
-
-            try:
-                proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
-            except KeyError:
-                pass
-            account = proxy_type.account_model(email=email, **proxy_settings)
-
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
-                account.flow = XTLSFlows.NONE
-
-            _add_user_to_inbound(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _add_user_to_inbound(node.api, inbound_tag, account)
+            account = _get_account(user, proxy_type, inbound_tag, email)
+            _queue_operation(ADD, inbound_tag, email, account)
 
 
 def remove_user(dbuser: "DBUser"):
     email = f"{dbuser.id}.{dbuser.username}"
+    xray.config.clients.remove_user(dbuser.id)
 
     for inbound_tag in xray.config.inbounds_by_tag:
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        _queue_operation(REMOVE, inbound_tag, email)
 
 
 def update_user(dbuser: "DBUser"):
     user = UserResponse.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
+    users_to_review.add(dbuser.id)
+    xray.config.clients.set_user(dbuser)
 
     active_inbounds = []
     for proxy_type, inbound_tags in user.inbounds.items():
         for inbound_tag in inbound_tags:
             active_inbounds.append(inbound_tag)
-            inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
-
-            try:
-                proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
-            except KeyError:
-                pass
-            account = proxy_type.account_model(email=email, **proxy_settings)
-
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
-                account.flow = XTLSFlows.NONE
-
-            _alter_inbound_user(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _alter_inbound_user(node.api, inbound_tag, account)
+            account = _get_account(user, proxy_type, inbound_tag, email)
+            _queue_operation(ALTER, inbound_tag, email, account)
 
     for inbound_tag in xray.config.inbounds_by_tag:
         if inbound_tag in active_inbounds:
             continue
         # remove disabled inbounds
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        _queue_operation(REMOVE, inbound_tag, email)
+
+
+def sync_users(added_user_ids: List[int], removed_user_ids: List[int]) -> dict:
+    """
+    Applies the changes of users modified in bulk to the cores: the users of ``removed_user_ids``
+    are removed and those of ``added_user_ids`` added over the cores' API, in the batches of their
+    operations queues. Above ``XRAY_BULK_SYNC_MAX_USERS`` users, the cores are restarted instead.
+
+    Returns how they were applied (``api`` or ``restart``), to how many users and in how many
+    seconds they were queued (or the cores restarted).
+    """
+    start = time.perf_counter()
+    users = len(added_user_ids) + len(removed_user_ids)
+
+    if users > XRAY_BULK_SYNC_MAX_USERS:
+        xray.core.restart(xray.config.include_db_users(reload=True))
+        for node_id, node in list(xray.nodes.items()):
+            if node.connected:
+                restart_node(node_id)
+        return {"method": "restart", "users": users, "elapsed": round(time.perf_counter() - start, 3)}
+
+    with GetDB() as db:
+        for dbuser in crud.iter_users(db, removed_user_ids):
+            remove_user(dbuser)
+
+        # the accounts are made from the clients of the config, like the ones of a restarted core
+        for dbuser in crud.iter_users(db, added_user_ids, with_proxies=True):
+            users_to_review.add(dbuser.id)
+            for inbound_tag, client in xray.config.clients.set_user(dbuser).items():
+                account = ProxyTypes(xray.config.inbounds_by_tag[inbound_tag]['protocol']).account_model(**client)
+                _queue_operation(ADD, inbound_tag, account.email, account)
+
+    return {"method": "api", "users": users, "elapsed": round(time.perf_counter() - start, 3)}
+
+
+def sync_node_users(node_id: int):
+    """
+    Queues adding every active user to a node whose core was started without users,
+    the node is usable while they're being added.
+    """
+    queue = _get_queue(node_id)
+    for inbound_tag, inbound in xray.config.inbounds_by_tag.items():
+        for client in xray.config.clients.get(inbound_tag):
+            account = ProxyTypes(inbound['protocol']).account_model(**client)
+            queue.put(ADD, inbound_tag, account.email, account)
 
 
 def remove_node(node_id: int):
+    queue = _queues.pop(node_id, None)
+    if queue:
+        queue.clear()
+
     if node_id in xray.nodes:
         try:
             xray.nodes[node_id].disconnect()
@@ -193,7 +247,7 @@ _connecting_nodes = {}
 
 
 @threaded_function
-def connect_node(node_id, config=None):
+def connect_node(node_id):
     global _connecting_nodes
 
     if _connecting_nodes.get(node_id):
@@ -217,14 +271,14 @@ def connect_node(node_id, config=None):
         _change_node_status(node_id, NodeStatus.connecting)
         logger.info(f"Connecting to \"{dbnode.name}\" node")
 
-        if config is None:
-            config = xray.config.include_db_users()
-
-        node.start(config)
+        # users are added over the API afterwards, so the config doesn't grow with them
+        node.start(xray.config.copy())
         version = node.get_version()
         _change_node_status(node_id, NodeStatus.connected, version=version)
         logger.info(f"Connected to \"{dbnode.name}\" node, xray run on v{version}")
 
+        sync_node_users(node_id)
+
     except Exception as e:
         _change_node_status(node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to connect to \"{dbnode.name}\" node")
@@ -237,7 +291,7 @@ def connect_node(node_id, config=None):
 
 
 @threaded_function
-def restart_node(node_id, config=None):
+def restart_node(node_id):
     with GetDB() as db:
         dbnode = crud.get_node_by_id(db, node_id)
 
@@ -250,16 +304,15 @@ def restart_node(node_id, config=None):
         node = xray.operations.add_node(dbnode)
 
     if not node.connected:
-        return connect_node(node_id, config)
+        return connect_node(node_id)
 
     try:
         logger.info(f"Restarting Xray core of \"{dbnode.name}\" node")
 
-        if config is None:
-            config = xray.config.include_db_users()
-
-        node.restart(config)
+        node.restart(xray.config.copy())
         logger.info(f"Xray core of \"{dbnode.name}\" node restarted")
+
+        sync_node_users(node_id)
     except Exception as e:
         _change_node_status(node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to restart node {node_id}")
@@ -272,6 +325,10 @@ def restart_node(node_id, config=None):
 __all__ = [
     "add_user",
     "remove_user",
+    "update_user",
+    "get_queues_stats",
+    "sync_users",
+    "sync_node_users",
     "add_node",
     "remove_node",
     "connect_node",
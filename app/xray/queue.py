@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from app import logger
+from xray_api import XRay as XRayAPI
+from xray_api import exc as xray_exc
+from xray_api.types.account import Account
+
+ADD = "add"
+REMOVE = "remove"
+ALTER = "alter"  # remove and add again, to apply new settings
+
+# number of threads shared by the queues of all cores
+MAX_WORKERS = 10
+# number of operations a worker takes from a queue at once
+BATCH_SIZE = 100
+# attempts of an operation that can't reach the core, and the delay (in seconds) before the second one, doubled after
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="xray-operations")
+
+
+class Operation:
+    __slots__ = ("action", "inbound_tag", "email", "account", "enqueued_at")
+
+    def __init__(self, action: str, inbound_tag: str, email: str, account: Optional[Account], enqueued_at: float):
+        self.action = action
+        self.inbound_tag = inbound_tag
+        self.email = email
+        self.account = account
+        self.enqueued_at = enqueued_at
+
+
+class OperationsQueue:
+    """
+    Pending user operations of a single core (the main core or a node).
+
+    Operations are coalesced by inbound and email, so only the latest one of a
+    user is sent, and are executed in batches over the core's API by one worker
+    of the shared pool at a time, which keeps them in order. A worker executes
+    a single batch before the queue is submitted again, so a long queue doesn't
+    hold a worker the others are waiting for.
+
+    Operations that can't reach the core are retried a few times. When the core
+    still can't be reached, the pending operations are dropped and ``on_error``
+    is called, to get the core synced again from scratch.
+    """
+
+    def __init__(self, get_api: Callable[[], XRayAPI], on_error: Optional[Callable[[Exception], None]] = None):
+        self.get_api = get_api
+        self.on_error = on_error
+        self.processed = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+
+        self._pending: "OrderedDict[tuple, Operation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._draining = False
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def average_latency(self) -> float:
+        return self.total_latency / self.processed if self.processed else 0.0
+
+    def put(self, action: str, inbound_tag: str, email: str, account: Optional[Account] = None):
+        key = (inbound_tag, email)
+        with self._lock:
+            previous = self._pending.pop(key, None)
+            if previous is None:
+                enqueued_at = time.time()
+            else:
+                enqueued_at = previous.enqueued_at
+                # the user may still exist on the core if removing it hasn't been sent yet
+                if action == ADD and previous.action in (REMOVE, ALTER):
+                    action = ALTER
+
+            self._pending[key] = Operation(action, inbound_tag, email, account, enqueued_at)
+
+            if not self._draining:
+                self._draining = True
+                executor.submit(self._drain)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def _drain(self):
+        """Executes a batch, and submits itself again if more operations are pending so the queues take turns."""
+        with self._lock:
+            batch = [self._pending.popitem(last=False)[1] for _ in range(min(BATCH_SIZE, len(self._pending)))]
+
+        try:
+            if batch:
+                self._execute_batch(batch)
+        finally:
+            with self._lock:
+                if self._pending:
+                    executor.submit(self._drain)
+                else:
+                    self._draining = False
+
+    def _execute_batch(self, batch: List[Operation]):
+        try:
+            api = self.get_api()
+        except Exception as err:
+            return self._fail(batch, err)
+
+        for i, operation in enumerate(batch):
+            try:
+                self._execute_with_retries(api, operation)
+            except Exception as err:
+                if self.on_error and isinstance(err, xray_exc.ConnectionError):
+                    return self._fail(batch[i:], err)
+                logger.error(f"Unable to {operation.action} user {operation.email} "
+                             f"on inbound {operation.inbound_tag}: {err}")
+
+            latency = time.time() - operation.enqueued_at
+            self.processed += 1
+            self.last_latency = latency
+            self.total_latency += latency
+
+    def _fail(self, operations: List[Operation], err: Exception):
+        """
+        Drops the operations the core missed, the main core gets all users in its
+        config once it's (re)started and the nodes are synced again by ``on_error``.
+        """
+        with self._lock:
+            dropped = len(operations) + len(self._pending)
+            self._pending.clear()
+
+        logger.warning(f"Unable to reach the core, {dropped} user operations are dropped: {err}")
+        if self.on_error:
+            self.on_error(err)
+
+    def _execute_with_retries(self, api: XRayAPI, operation: Operation):
+        delay = RETRY_DELAY
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return self._execute(api, operation)
+            except xray_exc.ConnectionError:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    @staticmethod
+    def _execute(api: XRayAPI, operation: Operation):
+        if operation.action in (REMOVE, ALTER):
+            try:
+                api.remove_inbound_user(tag=operation.inbound_tag, email=operation.email, timeout=30)
+            except xray_exc.EmailNotFoundError:
+                pass
+
+        if operation.action in (ADD, ALTER):
+            try:
+                api.add_inbound_user(tag=operation.inbound_tag, user=operation.account, timeout=30)
+            except xray_exc.EmailExistsError:
+                pass
@@ -34,6 +34,9 @@ XRAY_ASSETS_PATH = config("XRAY_ASSETS_PATH", default="/usr/local/share/xray")
 XRAY_EXCLUDE_INBOUND_TAGS = config("XRAY_EXCLUDE_INBOUND_TAGS", default='').split()
 XRAY_SUBSCRIPTION_URL_PREFIX = config("XRAY_SUBSCRIPTION_URL_PREFIX", default="").strip("/")
 XRAY_SUBSCRIPTION_PATH = config("XRAY_SUBSCRIPTION_PATH", default="sub").strip("/")
+# users changed in bulk are added to or removed from the cores over their API,
+# above this many users the cores are restarted with the users in their config instead
+XRAY_BULK_SYNC_MAX_USERS = config("XRAY_BULK_SYNC_MAX_USERS", cast=int, default=10000)
 
 TELEGRAM_API_TOKEN = config("TELEGRAM_API_TOKEN", default="")
 TELEGRAM_ADMIN_ID = config(
@@ -94,6 +97,9 @@ ONHOLD_STATUS_TEXT = config("ONHOLD_STATUS_TEXT", default="On-Hold")
 USERS_AUTODELETE_DAYS = config("USERS_AUTODELETE_DAYS", default=-1, cast=int)
 USER_AUTODELETE_INCLUDE_LIMITED_ACCOUNTS = config("USER_AUTODELETE_INCLUDE_LIMITED_ACCOUNTS", default=False, cast=bool)
 
+# approximate users counts (e.g. the total of a users list) are reused for this many seconds
+USERS_COUNT_CACHE_TTL = config("USERS_COUNT_CACHE_TTL", cast=int, default=60)
+
 
 # USERNAME: PASSWORD
 SUDOERS = {config("SUDO_USERNAME"): config("SUDO_PASSWORD")} \
@@ -131,11 +137,28 @@ NOTIFY_DAYS_LEFT = config(
 
 DISABLE_RECORDING_NODE_USAGE = config("DISABLE_RECORDING_NODE_USAGE", cast=bool, default=False)
 
+# users' usages collected between two flushes are journaled to this file, set it empty to disable journaling
+USER_USAGES_JOURNAL_PATH = config("USER_USAGES_JOURNAL_PATH", default="/var/lib/marzban/usages.journal")
+
+# users' online_at is only written when it moves forward by at least this many seconds
+USERS_ONLINE_AT_GRANULARITY = config("USERS_ONLINE_AT_GRANULARITY", cast=int, default=60)
+
+# users' hourly usages older than this many days are rolled up into daily ones,
+# and daily ones older than USAGES_DAILY_RETENTION_DAYS into monthly ones, negative values keep them forever
+USAGES_HOURLY_RETENTION_DAYS = config("USAGES_HOURLY_RETENTION_DAYS", cast=int, default=-1)
+USAGES_DAILY_RETENTION_DAYS = config("USAGES_DAILY_RETENTION_DAYS", cast=int, default=-1)
+
 # headers: profile-update-interval, support-url, profile-title
 SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
 SUB_SUPPORT_URL = config("SUB_SUPPORT_URL", default="https://t.me/")
 SUB_PROFILE_TITLE = config("SUB_PROFILE_TITLE", default="Subscription")
 
+# rendered subscriptions are reused for this many seconds while the user and hosts don't change, 0 disables caching
+SUB_CACHE_TTL = config("SUB_CACHE_TTL", cast=int, default=300)
+SUB_CACHE_SIZE = config("SUB_CACHE_SIZE", cast=int, default=10000)
+# subscriptions of at least this many bytes are compressed for the clients accepting it, -1 disables compression
+SUB_COMPRESSION_MIN_SIZE = config("SUB_COMPRESSION_MIN_SIZE", cast=int, default=1024)
+
 # discord webhook log
 DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 
@@ -144,5 +167,10 @@ DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 JOB_CORE_HEALTH_CHECK_INTERVAL = config("JOB_CORE_HEALTH_CHECK_INTERVAL", cast=int, default=10)
 JOB_RECORD_NODE_USAGES_INTERVAL = config("JOB_RECORD_NODE_USAGES_INTERVAL", cast=int, default=30)
 JOB_RECORD_USER_USAGES_INTERVAL = config("JOB_RECORD_USER_USAGES_INTERVAL", cast=int, default=10)
+# seconds to wait for the stats of each core, late ones are recorded by the next run
+JOB_RECORD_USAGES_NODE_DEADLINE = config("JOB_RECORD_USAGES_NODE_DEADLINE", cast=float, default=5)
+JOB_FLUSH_USER_USAGES_INTERVAL = config("JOB_FLUSH_USER_USAGES_INTERVAL", cast=int, default=30)
+JOB_RECORD_SUB_UPDATES_INTERVAL = config("JOB_RECORD_SUB_UPDATES_INTERVAL", cast=int, default=30)
 JOB_REVIEW_USERS_INTERVAL = config("JOB_REVIEW_USERS_INTERVAL", cast=int, default=10)
 JOB_SEND_NOTIFICATIONS_INTERVAL = config("JOB_SEND_NOTIFICATIONS_INTERVAL", cast=int, default=30)
+JOB_ROLLUP_USAGES_INTERVAL = config("JOB_ROLLUP_USAGES_INTERVAL", cast=int, default=3600)